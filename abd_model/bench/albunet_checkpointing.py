@@ -0,0 +1,88 @@
+"""Benchmark Albunet activation checkpointing: peak memory and training step time, by tile size.
+
+Usage: python bench/albunet_checkpointing.py [--encoder resnet50] [--bs 2] [--ts 512,768,1024] [--steps 3]
+
+Each configuration runs in its own process, so peak memory (GPU allocated, or CPU RSS) is not polluted by others.
+"""
+
+import sys
+import time
+import json
+import argparse
+import resource
+import subprocess
+
+
+def run(encoder, bs, ts, checkpointing, steps, precision):
+
+    import torch
+    from abd_model.nn.albunet import Albunet
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    train_config = {"pretrained": False, "activation_checkpointing": checkpointing}
+    nn = Albunet((3, ts, ts), (2, ts, ts), encoder, train_config).to(device).train()
+    optimizer = torch.optim.Adam(nn.parameters(), lr=0.0001)
+    dtype = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}[precision]
+
+    images = torch.rand(bs, 3, ts, ts, device=device)
+    masks = torch.randint(0, 2, (bs, ts, ts), device=device)
+
+    timings = []
+    for step in range(steps + 1):  # first step as warmup
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        tick = time.perf_counter()
+
+        with torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+            outputs = nn(images)
+        loss = torch.nn.functional.cross_entropy(outputs.float(), masks)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        if step:
+            timings.append(time.perf_counter() - tick)
+
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # Linux: KB
+
+    print(json.dumps({"device": device.type, "peak": peak, "time": sum(timings) / len(timings)}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--encoder", type=str, default="resnet50")
+    parser.add_argument("--bs", type=int, default=2)
+    parser.add_argument("--ts", type=str, default="512,768,1024")
+    parser.add_argument("--steps", type=int, default=3)
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"])
+    parser.add_argument("--checkpointing", type=str, nargs="+", default=["none", "encoder", "decoder", "all"])
+    parser.add_argument("--run", type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        ts, checkpointing = args.run.split(":")
+        return run(args.encoder, args.bs, int(ts), checkpointing, args.steps, args.precision)
+
+    print("Albunet {} - batch size {} - {}\n".format(args.encoder, args.bs, args.precision))
+    print("| tile size | checkpointing | peak memory (MB) | step time (s) |")
+    print("|---|---|---|---|")
+    for ts in map(int, args.ts.split(",")):
+        for checkpointing in args.checkpointing:
+            cmd = [sys.executable, __file__, "--run", "{}:{}".format(ts, checkpointing)]
+            cmd += ["--encoder", args.encoder, "--bs", str(args.bs), "--steps", str(args.steps), "--precision", args.precision]
+            out = subprocess.run(cmd, capture_output=True, text=True)
+            try:
+                result = json.loads(out.stdout.strip().split("\n")[-1])
+                peak, step = "{:.0f} ({})".format(result["peak"], result["device"]), "{:.2f}".format(result["time"])
+            except (ValueError, IndexError):
+                peak, step = "OOM", "-"
+            print("| {} | {} | {} | {} |".format(ts, checkpointing, peak, step), flush=True)
+
+
+if __name__ == "__main__":
+    main()
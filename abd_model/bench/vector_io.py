@@ -0,0 +1,58 @@
+"""Benchmark abd_model.vector formats against GeoJSON: write, full read, bbox read, and file size.
+
+Usage: python bench/vector_io.py [--features 1000000] [--formats geojson,geojsonl,fgb,gpkg,parquet] [--out /tmp]
+
+Features are building-like squares, randomly spread on a 1 degree square. The bbox read covers 1% of it.
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+import shapely
+
+from abd_model.vector import VectorWriter, read_vector
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--features", type=int, default=1000000)
+    parser.add_argument("--formats", type=str, default="geojson,geojsonl,fgb,gpkg,parquet")
+    parser.add_argument("--out", type=str, default="/tmp")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    xy = rng.random((args.features, 2))
+    size = 0.0001 + rng.random(args.features) * 0.0002
+    geometries = shapely.box(xy[:, 0], xy[:, 1], xy[:, 0] + size, xy[:, 1] + size)
+    ids = list(range(args.features))
+
+    print("{} features\n".format(args.features))
+    print("| format | write (s) | read (s) | bbox read (s) | bbox features | size (MB) |")
+    print("|---|---|---|---|---|---|")
+    for extension in args.formats.split(","):
+        path = os.path.join(os.path.expanduser(args.out), "bench_vector_io.{}".format(extension))
+
+        tick = time.perf_counter()
+        with VectorWriter(path, {"id": "int"}) as out:
+            for i in range(0, args.features, 65536):
+                out.write_batch(geometries[i : i + 65536], {"id": ids[i : i + 65536]})
+        write = time.perf_counter() - tick
+
+        tick = time.perf_counter()
+        count = sum([len(batch) for batch, columns in read_vector(path)])
+        read = time.perf_counter() - tick
+        assert count == args.features
+
+        tick = time.perf_counter()
+        count = sum([len(batch) for batch, columns in read_vector(path, bbox=(0.45, 0.45, 0.55, 0.55))])
+        bbox = time.perf_counter() - tick
+
+        row = (extension, write, read, bbox, count, os.path.getsize(path) / 2 ** 20)
+        print("| {} | {:.2f} | {:.2f} | {:.2f} | {} | {:.0f} |".format(*row), flush=True)
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
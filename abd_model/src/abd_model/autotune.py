@@ -0,0 +1,109 @@
+"""DataLoader settings autotuning, with results cached per dataset and machine fingerprint."""
+
+import os
+import json
+import time
+import random
+import hashlib
+import platform
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+
+def loader_kwargs(workers, prefetch_factor=None, persistent_workers=None, pin_memory=None):
+    """Return DataLoader performances related kwargs, with sensible defaults."""
+
+    kwargs = {"num_workers": workers, "pin_memory": torch.cuda.is_available() if pin_memory is None else pin_memory}
+    if workers:
+        kwargs["persistent_workers"] = True if persistent_workers is None else persistent_workers
+        kwargs["prefetch_factor"] = 2 if prefetch_factor is None else prefetch_factor
+
+    return kwargs
+
+
+def loader_fingerprint(dataset, bs, max_workers):
+    """Fingerprint a dataset, batch size and machine, as an autotune cache key."""
+
+    tiles_paths = getattr(dataset, "tiles_paths", None)
+    fingerprint = {
+        "dataset": os.path.abspath(tiles_paths[0][1]) if tiles_paths else type(dataset).__name__,
+        "len": len(dataset),
+        "shape_in": list(dataset.shape_in),
+        "mode": getattr(dataset, "mode", None),
+        "bs": bs,
+        "max_workers": max_workers,
+        "node": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "gpu": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+    }
+
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def autotune_cache_path():
+    cache = os.environ["XDG_CACHE_HOME"] if "XDG_CACHE_HOME" in os.environ else os.path.expanduser("~/.cache")
+    return os.path.join(cache, "abd_model", "autotune.json")
+
+
+def autotune_loader(dataset, bs, max_workers, log=None, batches=10, warmup=2, cache_path=None, force=False):
+    """Run short timed trials over workers and prefetch settings, and return the fastest DataLoader kwargs."""
+
+    cache_path = cache_path if cache_path else autotune_cache_path()
+    key = loader_fingerprint(dataset, bs, max_workers)
+
+    try:
+        with open(cache_path) as fp:
+            cache = json.load(fp)
+    except (OSError, ValueError):
+        cache = {}
+
+    if key in cache and not force:
+        if log:
+            settings, samples_per_sec = cache[key]["settings"], cache[key]["samples_per_sec"]
+            msg = "Autotune:\t\t cached {} workers, prefetch {} : {:.1f} samples/sec"
+            log.log(msg.format(*settings.values(), samples_per_sec))
+        return loader_kwargs(**cache[key]["settings"])
+
+    workers = [0] + [2 ** i for i in range(0, 8) if 2 ** i < max_workers] + [max_workers] if max_workers else [0]
+    trials = [{"workers": w, "prefetch_factor": p} for w in sorted(set(workers)) for p in ([2, 4] if w else [None])]
+
+    assert len(dataset), "Autotune: empty dataset, nothing to trial loading on"
+    assert batches > 0, "Autotune: at least one timed batch per trial is needed"
+
+    indices = list(range(len(dataset)))
+    random.Random(0).shuffle(indices)  # each trial read others tiles, to limit page cache bias
+    num = bs * (batches + warmup)
+
+    best = None
+    for i, settings in enumerate(trials):
+        subset = [indices[(i * num + j) % len(indices)] for j in range(num)]
+        loader = DataLoader(Subset(dataset, subset), batch_size=bs, drop_last=True, **loader_kwargs(**settings))
+
+        samples, tick = 0, None
+        for j, batch in enumerate(loader):
+            if j == warmup:
+                tick = time.monotonic()  # workers startup and first batches excluded
+            if j >= warmup:
+                samples += len(batch[0])
+        samples_per_sec = samples / (time.monotonic() - tick) if tick is not None and samples else 0.0
+        del loader
+
+        if log:
+            log.log("Autotune:\t\t {} workers, prefetch {} : {:.1f} samples/sec".format(*settings.values(), samples_per_sec))
+
+        if best is None or samples_per_sec > best["samples_per_sec"]:
+            best = {"settings": settings, "samples_per_sec": samples_per_sec}
+
+    if not best["samples_per_sec"]:  # no batch timed, e.g a dataset smaller than a batch: nothing worth caching
+        if log:
+            log.log("Autotune:\t\t no batch past warmup, fallback on {} workers".format(max_workers))
+        return loader_kwargs(max_workers)
+
+    cache[key] = best
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path, "w") as fp:
+        json.dump(cache, fp, indent=2)
+
+    return loader_kwargs(**best["settings"])
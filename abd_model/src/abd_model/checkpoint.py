@@ -0,0 +1,98 @@
+"""Non blocking checkpoints saving: CPU memory snapshot, background write, atomic rename, and retention."""
+
+import os
+import queue
+import threading
+
+import torch
+
+
+def snapshot(states):
+    """Copy a checkpoint states to CPU memory, so training could go on while they are written."""
+
+    if isinstance(states, torch.Tensor):
+        return states.detach().to("cpu", copy=True)
+    if isinstance(states, dict):
+        return type(states)((key, snapshot(value)) for key, value in states.items())
+    if isinstance(states, (list, tuple)):
+        return type(states)(snapshot(value) for value in states)
+
+    return states
+
+
+def weights_only(states):
+    """Lightweight checkpoint states, without optimizer related states. Faster to save and load, but not resumable."""
+
+    return {key: value for key, value in states.items() if key not in ["optimizer", "scaler"]}
+
+
+class CheckpointWriter:
+    def __init__(self, out, keep_last=None, keep_best=False, weights_only=False, log=None):
+        """Background checkpoints writer, keeping at most one pending snapshot in memory."""
+
+        self.out = out
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.weights_only = weights_only
+        self.log = log
+
+        self.saved = []  # (epoch, path) written
+        self.best = None  # (score, epoch, path), lower score is better
+        self.error = None
+
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def save(self, states, epoch, score=None):
+        """Snapshot states on CPU and queue them to be written. Block only while a previous write is still pending."""
+
+        assert self.error is None, "Unable to save checkpoint: {}".format(self.error)
+        states = weights_only(states) if self.weights_only else states
+        self.queue.put((snapshot(states), epoch, score))
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            states, epoch, score = item
+            path = os.path.join(self.out, "checkpoint-{:05d}.pth".format(epoch))
+            try:
+                torch.save(states, path + ".tmp")
+                os.replace(path + ".tmp", path)  # atomic, no partial checkpoint could be mistaken as a complete one
+                self.retention(epoch, path, score)
+            except Exception as error:
+                self.error = error
+                if self.log:
+                    self.log.log("ERROR: Unable to write checkpoint {}: {}".format(path, error))
+
+            self.queue.task_done()
+
+    def retention(self, epoch, path, score):
+        """Keep only the last K checkpoints, and the best one if asked."""
+
+        self.saved = [(e, p) for e, p in self.saved if p != path] + [(epoch, path)]
+        if score is not None and (self.best is None or score < self.best[0]):
+            self.best = (score, epoch, path)
+
+        if not self.keep_last:
+            return
+
+        best = self.best[2] if self.keep_best and self.best else None
+        for e, p in self.saved[: -self.keep_last]:
+            if p != best and os.path.isfile(p):
+                os.remove(p)
+        self.saved = [(e, p) for e, p in self.saved[: -self.keep_last] if p == best] + self.saved[-self.keep_last :]
+
+    def close(self):
+        """Wait for pending writes completion."""
+
+        self.queue.put(None)
+        self.thread.join()
+        assert self.error is None, "Unable to save checkpoint: {}".format(self.error)
+
+        if self.keep_best and self.best and self.log:
+            self.log.log("Best Checkpoint: {} (epoch {}, score {:.3f})".format(self.best[2], self.best[1], self.best[0]))
@@ -2,6 +2,8 @@ import os
 import sys
 import glob
 import toml
+import shutil
+import collections
 from importlib import import_module
 
 import re
@@ -9,7 +11,7 @@ import colorsys
 import webcolors
 from pathlib import Path
 
-from abd_model.tiles import tile_pixel_to_location, tiles_to_geojson
+from abd_model.tiles import tile_pixel_to_location, tiles_to_geojson, tiles_to_pyramid
 
 
 #
@@ -53,6 +55,9 @@ def load_config(path):
     if "bs" not in config["train"].keys():
         config["train"]["bs"] = 4
 
+    if "precision" not in config["train"].keys():
+        config["train"]["precision"] = "fp32"
+
     if "auth" not in config.keys():
         config["auth"] = {}
 
@@ -120,6 +125,22 @@ class Logs:
             print(msg, file=self.out)
 
 
+#
+# Parallelism
+#
+def ordered_map(executor, fn, iterable, window):
+    """Like executor.map, results yielded in order, but with at most window pending tasks, to keep memory bounded."""
+
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+
+    while pending:
+        yield pending.popleft().result()
+
+
 #
 # Colors
 #
@@ -184,7 +205,8 @@ def web_ui(out, base_url, coverage_tiles, selected_tiles, ext, template, union_t
         web_ui = open(template, "r").read()
         web_ui = re.sub("{{base_url}}", base_url, web_ui)
         web_ui = re.sub("{{ext}}", ext, web_ui)
-        web_ui = re.sub("{{tiles}}", "tiles.json" if selected_tiles else "''", web_ui)
+        web_ui = re.sub("{{tiles}}", "tiles.json" if selected_tiles and not union_tiles else "''", web_ui)
+        web_ui = re.sub("{{coverage}}", "coverage" if selected_tiles else "", web_ui)
 
         if coverage_tiles:
             tile = list(coverage_tiles)[0]  # Could surely be improved, but for now, took the first tile to center on
@@ -198,6 +220,10 @@ def web_ui(out, base_url, coverage_tiles, selected_tiles, ext, template, union_t
     for template in templates:
         process_template(template)
 
-    if selected_tiles:
+    if selected_tiles and not union_tiles:  # each tile needed, e.g to browse them one by one
         with open(os.path.join(out, "tiles.json"), "w", encoding="utf-8") as fp:
-            fp.write(tiles_to_geojson(selected_tiles, union_tiles))
+            tiles_to_geojson(selected_tiles, union_tiles, fp)
+
+    if selected_tiles:  # per viewport coverage, whatever the number of tiles
+        shutil.rmtree(os.path.join(out, "coverage"), ignore_errors=True)
+        tiles_to_pyramid(selected_tiles, os.path.join(out, "coverage"))
@@ -0,0 +1,89 @@
+"""Asynchronous HTTP fetching, with a global rate limit, keep-alive connections pool, and retries."""
+
+import time
+import random
+import asyncio
+
+import aiohttp
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        """Rate limiter, shared by all requests: at most rate requests per second, and burst at once."""
+
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def fetch(session, url, bucket, retries=3, backoff=0.5):
+    """GET an URL content, as bytes, or None. Network errors, 429 and 5xx are retried, with exponential backoff and
+    full jitter (or server Retry-After if any). Each attempt waits for a rate limiter token."""
+
+    for attempt in range(retries + 1):
+        delay = random.uniform(0, backoff * 2 ** attempt)
+        await bucket.acquire()
+
+        try:
+            async with session.get(url) as res:
+                if res.status == 200:
+                    return await res.read()
+                if res.status != 429 and res.status < 500:
+                    return None
+                if res.headers.get("Retry-After", "").isdigit():
+                    delay = min(int(res.headers["Retry-After"]), 60)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+        if attempt < retries:
+            await asyncio.sleep(delay)
+
+    return None
+
+
+async def fetch_all(items, rate, workers, timeout, host_workers=None, retries=3):
+    """Fetch (key, url) items, with workers concurrent requests, at most host_workers on a same host, and rate
+    requests per second. Yield (key, url, content bytes or None), in completion order."""
+
+    bucket = TokenBucket(rate)
+    connector = aiohttp.TCPConnector(limit=workers, limit_per_host=host_workers if host_workers else 0)
+    results = asyncio.Queue(maxsize=workers * 2)  # backpressure: fetching waits for results to be consumed
+    items = iter(items)  # shared by all workers
+
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+
+        async def worker():
+            try:
+                for key, url in items:
+                    await results.put((key, url, await fetch(session, url, bucket, retries)))
+            finally:
+                await results.put(None)
+
+        tasks = [asyncio.ensure_future(worker()) for _ in range(workers)]
+        try:
+            done = 0
+            while done < len(tasks):
+                result = await results.get()
+                if result is None:
+                    done += 1
+                    continue
+                yield result
+
+            for task in tasks:
+                task.result()  # raise workers exceptions, if any
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -3,59 +3,96 @@ from rasterio.warp import transform_geom
 from rasterio.features import rasterize
 from rasterio.transform import from_bounds
 
-import mercantile
-from supermercado import burntiles
+import numpy as np
+import shapely
 from shapely.geometry import shape, mapping
 
 from abd_model.tiles import tile_bbox
 
 
-def geojson_parse_feature(zoom, srid, feature_map, feature, buffer=0):
-    def geojson_parse_polygon(zoom, srid, feature_map, polygon):
+def geojson_polygons(srid, geometry, buffer=0):
+    """Return a geometry polygons, as 2D shapely geometries in EPSG:4326. Invalid or empty ones are skipped.
 
-        if isinstance(polygon["coordinates"], list):  # https://github.com/Toblerity/Shapely/issues/245
-            for i, ring in enumerate(polygon["coordinates"]):  # GeoJSON coordinates could be N dimensionals
-                polygon["coordinates"][i] = [[x, y] for point in ring for x, y in zip([point[0]], [point[1]])]
+    geometry: either a GeoJSON like geometry dict or a shapely geometry (or None), in srid coordinates.
+    """
 
-        if srid != 4326:
-            try:
-                polygon = transform_geom(CRS.from_epsg(srid), CRS.from_epsg(4326), polygon)
-            except:  # negative buffer could lead to empty/invalid geom
-                return feature_map
+    if geometry is None:
+        return []
 
+    try:
+        geometry = shape(geometry) if isinstance(geometry, dict) else geometry
+    except:
+        return []
+    geometries = list(geometry.geoms) if geometry.geom_type == "GeometryCollection" else [geometry]
+
+    polygons = []
+    for geometry in geometries:
         try:
-            for tile in burntiles.burn([{"type": "feature", "geometry": polygon}], zoom=zoom):
-                feature_map[mercantile.Tile(*tile)].append({"type": "feature", "geometry": polygon})
-        except:
-            pass
+            geometry, geometry_srid = shapely.force_2d(geometry), srid
+            if buffer:  # be sure to be planar
+                geometry = shape(transform_geom(CRS.from_epsg(srid), CRS.from_epsg(3857), mapping(geometry)))
+                geometry, geometry_srid = geometry.buffer(buffer), 3857
+            if geometry_srid != 4326 and geometry.geom_type in ["Polygon", "MultiPolygon"]:
+                geometry = shape(transform_geom(CRS.from_epsg(geometry_srid), CRS.from_epsg(4326), mapping(geometry)))
+        except:  # negative buffer could lead to empty/invalid geom
+            continue
+
+        if geometry.is_empty:
+            continue
+        if geometry.geom_type == "Polygon":
+            polygons.append(geometry)
+        elif geometry.geom_type == "MultiPolygon":
+            polygons.extend(geometry.geoms)
+
+    return polygons
+
+
+def polygons_tiles(polygons, zoom):
+    """Index EPSG:4326 polygons on tiles, at zoom. Tiles ranges are computed from all polygons bounds at once, and
+    exact intersections are only checked for polygons spanning several tiles. Return (polygons indices, xs, ys)."""
+
+    polygons = np.asarray(polygons, dtype=object)
+    if not len(polygons):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
 
-        return feature_map
+    n = 2 ** zoom
+    w, s, e, north = shapely.bounds(polygons).T
+    lat = np.radians(np.clip(np.stack([north, s]), -85.0511287798066, 85.0511287798066))
+    x = (np.stack([w, e]) + 180.0) / 360.0 * n
+    y = (1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * n
 
-    def geojson_parse_geometry(zoom, srid, feature_map, geometry, buffer):
-        if buffer:
-            geometry = transform_geom(CRS.from_epsg(srid), CRS.from_epsg(3857), geometry)  # be sure to be planar
-            geometry = mapping(shape(geometry).buffer(buffer))
-            srid = 3857
+    # A polygon touching a tile only on its max edge does not lie on it
+    x0 = np.clip(np.floor(x[0]), 0, n - 1).astype(np.int64)
+    y0 = np.clip(np.floor(y[0]), 0, n - 1).astype(np.int64)
+    x1 = np.maximum(np.clip(np.ceil(x[1]) - 1, 0, n - 1).astype(np.int64), x0)
+    y1 = np.maximum(np.clip(np.ceil(y[1]) - 1, 0, n - 1).astype(np.int64), y0)
 
-        if geometry["type"] == "Polygon":
-            feature_map = geojson_parse_polygon(zoom, srid, feature_map, geometry)
+    width = x1 - x0 + 1
+    counts = width * (y1 - y0 + 1)
+    counts[np.isnan(w)] = 0
 
-        elif geometry["type"] == "MultiPolygon":
-            for polygon in geometry["coordinates"]:
-                feature_map = geojson_parse_polygon(zoom, srid, feature_map, {"type": "Polygon", "coordinates": polygon})
+    indices = np.repeat(np.arange(len(polygons)), counts)
+    k = np.arange(len(indices)) - np.repeat(np.cumsum(counts) - counts, counts)
+    xs = np.repeat(x0, counts) + k % np.repeat(width, counts)
+    ys = np.repeat(y0, counts) + k // np.repeat(width, counts)
 
-        return feature_map
+    keep = np.repeat(counts == 1, counts)
+    several = ~keep
+    if several.any():
+        tw, te = xs[several] / n * 360.0 - 180.0, (xs[several] + 1) / n * 360.0 - 180.0
+        tn = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * ys[several] / n))))
+        ts = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * (ys[several] + 1) / n))))
+        keep[several] = shapely.intersects(polygons[indices[several]], shapely.box(tw, ts, te, tn))
 
-    if not feature or not feature["geometry"]:
-        return feature_map
+    return indices[keep], xs[keep], ys[keep]
 
-    if feature["geometry"]["type"] == "GeometryCollection":
-        for geometry in feature["geometry"]["geometries"]:
-            feature_map = geojson_parse_geometry(zoom, srid, feature_map, geometry, buffer)
-    else:
-        feature_map = geojson_parse_geometry(zoom, srid, feature_map, feature["geometry"], buffer)
 
-    return feature_map
+def mercator(coords):
+    """Project EPSG:4326 coordinates, as a N,2 array, to EPSG:3857. Vectorized, to be used with shapely.transform."""
+
+    x = np.radians(coords[:, 0]) * 6378137.0
+    y = np.log(np.tan(np.pi / 4.0 + np.radians(np.clip(coords[:, 1], -85.0511287798066, 85.0511287798066)) / 2.0))
+    return np.stack([x, y * 6378137.0], axis=1)
 
 
 def geojson_srid(feature_collection):
@@ -80,3 +117,15 @@ def geojson_tile_burn(tile, features, srid, ts, burn_value=1):
         return rasterize(shapes, out_shape=ts, transform=from_bounds(*tile_bbox(tile, mercator=True), *ts))
     except:
         return None
+
+
+def geometries_tile_burn(tile, geometries, ts, burn_value=1):
+    """Burn tile with shapely geometries, already in EPSG:3857."""
+
+    shapes = ((geometry, burn_value) for geometry in geometries)
+    transform = from_bounds(*tile_bbox(tile, mercator=True), *ts)
+
+    try:
+        return rasterize(shapes, out_shape=ts, transform=transform, dtype=np.uint8)
+    except:
+        return None
@@ -14,3 +14,10 @@ def get(label, predicted, config=None):
         iou = float("NaN")
 
     return iou
+
+
+def get_from_confusion(tn, fn, fp, tp):
+    """Vectorized IoU, from confusion counts tensors. NaN where nothing expected nor predicted."""
+
+    tn, fn, fp, tp = (t.double() for t in (tn, fn, fp, tp))
+    return tp / (fp + fn + tp)
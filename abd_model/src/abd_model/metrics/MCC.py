@@ -14,3 +14,10 @@ def get(label, predicted, config=None):
         mcc = float("NaN")
 
     return mcc
+
+
+def get_from_confusion(tn, fn, fp, tp):
+    """Vectorized MCC, from confusion counts tensors. NaN where undefined."""
+
+    tn, fn, fp, tp = (t.double() for t in (tn, fn, fp, tp))
+    return (tp * tn - fp * fn) / ((tp + fp) * (tp + fn) * (tn + fp) * (tn + fn)).sqrt()
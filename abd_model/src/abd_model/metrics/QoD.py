@@ -21,3 +21,17 @@ def get(label, mask, config=None):
     qod = 0.0 if qod < 0.0 else qod  # Corner case prophilaxy
 
     return qod / 100.0
+
+
+def get_from_confusion(tn, fn, fp, tp):
+    """Vectorized QoD, from confusion counts tensors."""
+
+    tn, fn, fp, tp = (t.double() for t in (tn, fn, fp, tp))
+    iou = tp / (tp + fn + fp)
+    ratio = 100 * torch.max(tp + fp, tp + fn) / (tn + fn + fp + tp)
+    dist = torch.where(torch.isnan(iou), torch.zeros_like(iou), 1.0 - iou)
+
+    qod = 100 - (dist * ((ratio + 1.0).log() + 1e-7) * (100 / math.log(100)))
+    qod = qod.clamp(min=0.0)  # Corner case prophilaxy
+
+    return qod / 100.0
@@ -1,52 +1,128 @@
-import math
 import torch
+import torch.distributed as dist
 from abd_model.core import load_module
 
 
 class Metrics:
-    def __init__(self, metrics, classes, config=None):
+    def __init__(self, metrics, classes, device="cpu", config=None):
+        """Per tile metrics mean and standard deviation, from batched confusion counts and Welford running statistics."""
+
         self.config = config
         self.classes = classes
-        self.metrics = []
-        for classe in classes:
-            self.metrics.append({metric: [] for metric in metrics})
         self.modules = {metric: load_module("abd_model.metrics." + metric) for metric in metrics}
-        self.n = 0
 
-    def add(self, label, output):
+        shape = (len(self.modules), len(classes))  # NaN values (i.e undefined metric on a tile) are not accounted
+        self.n = torch.zeros(shape, dtype=torch.float64, device=device)
+        self.mean = torch.zeros(shape, dtype=torch.float64, device=device)
+        self.m2 = torch.zeros(shape, dtype=torch.float64, device=device)
+
+    def add(self, labels, outputs):
+        """Accumulate a batch: labels as N,H,W classes indices, outputs as N,C,H,W. A single tile is also accepted."""
+
         assert self.modules
-        assert self.metrics
-        self.n += 1
-        for metric, module in self.modules.items():
-            for c, classe in enumerate(self.classes):
-                mask = (output[c] > 0.5).float()
-                self.metrics[c][metric].append(module.get(label, mask, self.config))
+        if outputs.dim() == 3:
+            labels, outputs = labels.unsqueeze(0), outputs.unsqueeze(0)
+
+        counts = confusion_counts(labels, outputs).to(self.n.device)
+        tn, fn, fp, tp = counts.unbind(dim=-1)
+        values = torch.stack([module.get_from_confusion(tn, fn, fp, tp) for module in self.modules.values()])  # M,N,C
+
+        valid = ~torch.isnan(values)
+        n = valid.sum(dim=1).double()
+        mean = torch.where(valid, values, torch.zeros_like(values)).sum(dim=1) / n.clamp(min=1)
+        m2 = torch.where(valid, (values - mean.unsqueeze(1)) ** 2, torch.zeros_like(values)).sum(dim=1)
+
+        self.n, self.mean, self.m2 = merge(self.n, self.mean, self.m2, n, mean, m2)
+
+    def reduce(self):
+        """Merge running statistics across ranks."""
+
+        if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+            return
+
+        local = torch.stack([self.n, self.mean, self.m2])
+        gathered = [torch.zeros_like(local) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, local)
+
+        n, mean, m2 = torch.zeros_like(self.n), torch.zeros_like(self.mean), torch.zeros_like(self.m2)
+        for other in gathered:
+            n, mean, m2 = merge(n, mean, m2, *other)
+        self.n, self.mean, self.m2 = n, mean, m2
 
     def get(self):
-        assert self.metrics
+        nan = torch.full_like(self.mean, float("NaN"))
+        μ = torch.where(self.n > 0, self.mean, nan).cpu()
+        σ = torch.where(self.n > 0, (self.m2 / self.n.clamp(min=1)).sqrt(), nan).cpu()
 
         results = []
         for c, classe in enumerate(self.classes):
-            μ = {}
-            σ = {}
-            for metric, values in self.metrics[c].items():
-                n = sum([1 for v in values if not math.isnan(v)])
+            results.append(
+                {metric: {"μ": float(μ[m, c]), "σ": float(σ[m, c])} for m, metric in enumerate(self.modules.keys())}
+            )
+
+        return results
+
+
+def merge(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """Merge two sets of running statistics (count, mean, sum of squared deviations). Cf Chan et al. parallel algorithm."""
+
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    ratio = torch.where(n > 0, n_b / n.clamp(min=1), torch.zeros_like(n))
+
+    return n, mean_a + delta * ratio, m2_a + m2_b + delta ** 2 * n_a * ratio
+
 
-                try:
-                    μ[metric] = sum([v for v in values if not math.isnan(v)]) / n
-                except ZeroDivisionError:
-                    μ[metric] = float("NaN")
+class StreamingMetrics:
+    def __init__(self, metrics, classes, device="cpu", config=None):
+        """Dataset wide metrics, from per class confusion counts accumulated on device, without any per tile value."""
 
-                try:
-                    σ[metric] = sum({(math.sqrt(((v - μ[metric]) ** 2))) for v in values if not math.isnan(v)}) / n
-                except ZeroDivisionError:
-                    σ[metric] = float("NaN")
+        self.config = config
+        self.classes = classes
+        self.modules = {metric: load_module("abd_model.metrics." + metric) for metric in metrics}
+        self.counts = torch.zeros((len(classes), 4), dtype=torch.float64, device=device)  # tn, fn, fp, tp
+
+    def add(self, labels, outputs):
+        """Accumulate a batch: labels as N,H,W classes indices, outputs as N,C,H,W."""
+
+        self.counts += confusion_counts(labels, outputs).sum(dim=0)
 
-            results.append({metric: {"μ": μ[metric], "σ": σ[metric]} for metric in self.metrics[c]})
+    def reduce(self, extra=None):
+        """Sum counts, and an optional extra tensor, across ranks with a single all-reduce. Return reduced extra."""
+
+        if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+            return extra
+
+        packed = self.counts.view(-1) if extra is None else torch.cat([self.counts.view(-1), extra.double().view(-1)])
+        dist.all_reduce(packed)
+        self.counts = packed[: self.counts.nelement()].view(self.counts.shape)
+
+        return None if extra is None else packed[self.counts.nelement() :].view(extra.shape)
+
+    def get(self):
+        results = []
+        counts = self.counts.cpu()
+        for c, classe in enumerate(self.classes):
+            tn, fn, fp, tp = counts[c]
+            results.append({m: float(module.get_from_confusion(tn, fn, fp, tp)) for m, module in self.modules.items()})
 
         return results
 
 
+def confusion_counts(labels, outputs):
+    """Per tile and per class confusion counts, as a N,C,4 (tn, fn, fp, tp) tensor, computed in a single bincount."""
+
+    N, C, H, W = outputs.shape
+    predicted = outputs > 0.5
+    expected = labels.view(N, 1, H, W) == torch.arange(C, device=labels.device).view(1, C, 1, 1)
+
+    code = expected.long() * 2 + predicted.long()  # 0: tn, 1: fp, 2: fn, 3: tp
+    code += torch.arange(N * C, device=labels.device).view(N, C, 1, 1) * 4
+    counts = torch.bincount(code.view(-1), minlength=N * C * 4).view(N, C, 4)
+
+    return counts[:, :, [0, 2, 1, 3]]
+
+
 def confusion(label, predicted):
 
     confusion = predicted.view(-1).float() / label.view(-1).float()
@@ -1,9 +1,28 @@
+import contextlib
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from abd_model.core import load_module
 
 
+@contextlib.contextmanager
+def frozen_batchnorm_stats(module):
+    """Restore module BatchNorm running statistics on exit, as they were on enter."""
+
+    batchnorms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    stats = [[buffer.clone() for buffer in (m.running_mean, m.running_var, m.num_batches_tracked)] for m in batchnorms]
+    try:
+        yield
+    finally:
+        with torch.no_grad():
+            for m, (mean, var, num) in zip(batchnorms, stats):
+                m.running_mean.copy_(mean)
+                m.running_var.copy_(var)
+                m.num_batches_tracked.copy_(num)
+
+
 class ConvRelu(nn.Module):
     """3x3 convolution followed by ReLU activation building block."""
 
@@ -58,6 +77,27 @@ class Albunet(nn.Module):
         except:
             pretrained = False
 
+        # Activation checkpointing: trade blocks activations memory, for their recompute on backward
+        encoder_blocks = ["layer1", "layer2", "layer3", "layer4"]
+        decoder_blocks = ["center", "dec0", "dec1", "dec2", "dec3", "dec4", "dec5"]
+        try:
+            checkpointing = str(train_config["activation_checkpointing"]).replace(" ", "").split(",")
+        except:
+            checkpointing = ["none"]
+
+        self.checkpointing = set()
+        for blocks in checkpointing:
+            if blocks in ["encoder", "all"]:
+                self.checkpointing.update(encoder_blocks)
+            if blocks in ["decoder", "all"]:
+                self.checkpointing.update(decoder_blocks)
+            if blocks in encoder_blocks + decoder_blocks:
+                self.checkpointing.add(blocks)
+            assert blocks in encoder_blocks + decoder_blocks + ["encoder", "decoder", "all", "none", ""], (
+                "Albunet, expects as activation_checkpointing: none, encoder, decoder, all, or blocks names: "
+                + ", ".join(encoder_blocks + decoder_blocks)
+            )
+
         models = load_module("torchvision.models")
         self.encoder = getattr(models, encoder)(pretrained=pretrained)
         # https://github.com/pytorch/vision/blob/master/torchvision/models/resnet.py
@@ -81,6 +121,22 @@ class Albunet(nn.Module):
 
         self.final = nn.Conv2d(num_filters, num_classes, kernel_size=1)
 
+    def block(self, name, module, x):
+        """Run a block, with activation checkpointing if asked, and relevant (i.e training)."""
+
+        if name in self.checkpointing and self.training and torch.is_grad_enabled():
+            calls = []
+
+            def run(x):
+                # Backward recompute: BatchNorm running statistics were already updated by forward
+                with frozen_batchnorm_stats(module) if calls else contextlib.nullcontext():
+                    calls.append(True)
+                    return module(x)
+
+            return checkpoint(run, x, use_reentrant=False)
+
+        return module(x)
+
     def forward(self, x):
 
         enc0 = self.encoder.conv1(x)
@@ -88,18 +144,18 @@ class Albunet(nn.Module):
         enc0 = self.encoder.relu(enc0)
         enc0 = self.encoder.maxpool(enc0)
 
-        enc1 = self.encoder.layer1(enc0)
-        enc2 = self.encoder.layer2(enc1)
-        enc3 = self.encoder.layer3(enc2)
-        enc4 = self.encoder.layer4(enc3)
+        enc1 = self.block("layer1", self.encoder.layer1, enc0)
+        enc2 = self.block("layer2", self.encoder.layer2, enc1)
+        enc3 = self.block("layer3", self.encoder.layer3, enc2)
+        enc4 = self.block("layer4", self.encoder.layer4, enc3)
 
-        center = self.center(nn.functional.max_pool2d(enc4, kernel_size=2, stride=2))
+        center = self.block("center", self.center, nn.functional.max_pool2d(enc4, kernel_size=2, stride=2))
 
-        dec0 = self.dec0(torch.cat([enc4, center], dim=1))
-        dec1 = self.dec1(torch.cat([enc3, dec0], dim=1))
-        dec2 = self.dec2(torch.cat([enc2, dec1], dim=1))
-        dec3 = self.dec3(torch.cat([enc1, dec2], dim=1))
-        dec4 = self.dec4(dec3)
-        dec5 = self.dec5(dec4)
+        dec0 = self.block("dec0", self.dec0, torch.cat([enc4, center], dim=1))
+        dec1 = self.block("dec1", self.dec1, torch.cat([enc3, dec0], dim=1))
+        dec2 = self.block("dec2", self.dec2, torch.cat([enc2, dec1], dim=1))
+        dec3 = self.block("dec3", self.dec3, torch.cat([enc1, dec2], dim=1))
+        dec4 = self.block("dec4", self.dec4, dec3)
+        dec5 = self.block("dec5", self.dec5, dec4)
 
         return self.final(dec5)
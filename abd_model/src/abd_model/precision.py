@@ -0,0 +1,33 @@
+"""Mixed precision helpers: autocast and gradient scaling, on CPU or GPU."""
+
+import contextlib
+import torch
+
+
+precisions = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def check_precision(precision, device):
+    """Check if a precision is available on a device. Exit on error if not."""
+
+    device = torch.device(device)
+    assert precision in precisions.keys(), "Unknown precision {}, expects: {}".format(precision, ", ".join(precisions))
+    assert not (precision == "fp16" and device.type == "cpu"), "fp16 precision imply a GPU, use bf16 instead on CPU"
+
+    if precision == "bf16" and device.type == "cuda":
+        assert torch.cuda.is_bf16_supported(), "bf16 precision not supported by this GPU, use fp16 instead"
+
+
+def autocast(device, precision):
+    """Return an autocast context for a precision, on a device. Outputs should be cast back to float32 by the caller."""
+
+    if precision == "fp32":
+        return contextlib.nullcontext()
+
+    return torch.autocast(device_type=torch.device(device).type, dtype=precisions[precision])
+
+
+def grad_scaler(precision):
+    """Return a gradient scaler, enabled only on fp16, as bf16 doesn't need any loss scaling."""
+
+    return torch.cuda.amp.GradScaler(enabled=precision == "fp16")  # torch.amp.GradScaler is torch >= 2.3 only
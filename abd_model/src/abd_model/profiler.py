@@ -0,0 +1,160 @@
+"""Training steps profiler: phases timings, throughput and peak memory, per epoch."""
+
+import os
+import json
+import time
+
+import numpy as np
+import torch
+
+
+class StepProfiler:
+    """Time each training step phase, and summarize them by epoch.
+
+    Phases are recorded as laps: each lap duration is the time elapsed since the previous one,
+    so data wait is the time spent between the end of previous step and the next batch availability.
+    """
+
+    phases = ["data", "h2d", "forward", "backward", "optimizer"]
+
+    def __init__(self, device, enabled=True, trace=None, trace_dir=None):
+        self.device = torch.device(device)
+        self.enabled = enabled
+        self.trace = trace  # (first, last) steps window, 1-based, to trace with torch profiler
+        self.trace_dir = trace_dir
+        self.torch_profiler = None
+        self.reset()
+
+    def reset(self):
+        """Reset counters, to be called on each epoch start."""
+
+        self.timings = {phase: [] for phase in self.phases}
+        self.samples = 0
+        self.steps = 0
+        self.start = time.perf_counter()
+        self.tick = self.start
+
+        if self.enabled and self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+        if self.trace and self.trace[0] <= 1:
+            self.trace_start()
+
+    def trace_start(self):
+        if self.torch_profiler is not None:
+            return
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        self.torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.torch_profiler.__enter__()
+
+    def trace_stop(self, epoch=None):
+        """Close and export the trace if any, to be called on each epoch end too, as an epoch could be shorter."""
+
+        if self.torch_profiler is None:
+            return
+
+        self.torch_profiler.__exit__(None, None, None)
+        path = os.path.join(self.trace_dir, "trace-{:05d}.json".format(epoch if epoch else 0))
+        self.torch_profiler.export_chrome_trace(path)
+        self.torch_profiler = None
+        self.trace = None  # trace only once
+
+    def sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def lap(self, phase):
+        """Record time elapsed since previous lap as phase duration."""
+
+        if not self.enabled:
+            return
+
+        self.sync()
+        tock = time.perf_counter()
+        self.timings[phase].append(tock - self.tick)
+        self.tick = tock
+
+    def step(self, num_samples, epoch=None):
+        """Close a step, and handle torch profiler trace window if any."""
+
+        self.steps += 1
+        self.samples += num_samples
+
+        if not self.trace:
+            return
+
+        first, last = self.trace
+        if self.steps == first - 1:
+            self.trace_start()
+
+        elif self.steps == last:
+            self.trace_stop(epoch)
+
+        self.tick = time.perf_counter()  # don't account profiler overhead as data wait
+
+    def summary(self):
+        """Return current epoch summary, as a serializable dict."""
+
+        self.sync()
+        elapsed = time.perf_counter() - self.start
+        summary = {
+            "steps": self.steps,
+            "samples": self.samples,
+            "elapsed": elapsed,
+            "samples_per_sec": self.samples / elapsed if elapsed else float("NaN"),
+            "peak_memory_mb": None,
+            "phases": {},
+        }
+
+        if self.device.type == "cuda":
+            summary["peak_memory_mb"] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+
+        total = sum([sum(timings) for timings in self.timings.values()])
+        for phase, timings in self.timings.items():
+            if not timings:
+                continue
+            timings = np.array(timings) * 1000  # ms
+            summary["phases"][phase] = {
+                "mean": float(timings.mean()),
+                "p50": float(np.percentile(timings, 50)),
+                "p90": float(np.percentile(timings, 90)),
+                "p99": float(np.percentile(timings, 99)),
+                "share": float(timings.sum() / 1000 / total) if total else float("NaN"),
+            }
+
+        return summary
+
+    def log(self, log, summary):
+        """Log an epoch summary."""
+
+        log.log("{}{:.1f}".format("Samples/sec:".ljust(25, " "), summary["samples_per_sec"]))
+        if summary["peak_memory_mb"] is not None:
+            log.log("{}{:.0f} MB".format("Peak Memory:".ljust(25, " "), summary["peak_memory_mb"]))
+
+        if summary["phases"]:
+            log.log("{}  mean\t  p50\t  p90\t  p99\t  share".format("Step (ms)".ljust(25, " ")))
+        for phase, t in summary["phases"].items():
+            log.log(
+                "{}{:>6.1f}\t{:>6.1f}\t{:>6.1f}\t{:>6.1f}\t{:>6.1%}".format(
+                    (" - " + phase).ljust(25, " "), t["mean"], t["p50"], t["p90"], t["p99"], t["share"]
+                )
+            )
+
+    def dump(self, path, epoch, summary):
+        """Append an epoch summary to a JSON file."""
+
+        try:
+            with open(path) as fp:
+                profile = json.load(fp)
+        except (OSError, ValueError):
+            profile = {"epochs": []}
+
+        profile["epochs"] = [e for e in profile["epochs"] if e["epoch"] != epoch]  # resume friendly
+        profile["epochs"].append({"epoch": epoch, **summary})
+
+        with open(path, "w") as fp:
+            json.dump(profile, fp, indent=2)
@@ -0,0 +1,48 @@
+"""PyTorch-compatible samplers. Cf: https://pytorch.org/docs/stable/data.html#data-loading-order-and-sampler """
+
+import math
+import numpy as np
+import torch.utils.data
+
+
+class DistributedForegroundSampler(torch.utils.data.Sampler):
+    def __init__(self, foreground, num_replicas, rank, empty_ratio=0.1, seed=0):
+        """Distributed sampler, capping background only tiles share, on each epoch.
+
+        foreground: per dataset item foreground pixels ratio, 0.0 for an empty (i.e background only) tile.
+        empty_ratio: max share of empty tiles among each epoch samples. Empty tiles drawn change on each epoch.
+        """
+
+        assert 0.0 <= empty_ratio < 1.0, "empty ratio must be in [0, 1["
+
+        self.foreground = np.asarray(foreground)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+        self.informative = np.flatnonzero(self.foreground > 0.0)
+        self.empty = np.flatnonzero(self.foreground == 0.0)
+        assert len(self.informative), "No tile with foreground, in dataset"
+
+        num_empty = math.floor(len(self.informative) * empty_ratio / (1.0 - empty_ratio))
+        self.num_empty = min(num_empty, len(self.empty))
+        self.epoch_size = len(self.informative) + self.num_empty
+        self.num_samples = math.ceil(self.epoch_size / self.num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)  # same on each rank
+
+        empty = rng.choice(self.empty, self.num_empty, replace=False) if self.num_empty else self.empty[:0]
+        indices = rng.permutation(np.concatenate([self.informative, empty]))
+
+        padding = self.num_samples * self.num_replicas - len(indices)  # evenly divisible between ranks
+        indices = np.concatenate([indices, indices[:padding]])
+
+        return iter(indices[self.rank :: self.num_replicas].tolist())
+
+    def __len__(self):
+        return self.num_samples
@@ -16,8 +16,8 @@ import cv2
 import json
 import psycopg2
 import rasterio
+import shapely
 import mercantile
-import supermercado
 
 warnings.simplefilter("ignore", UserWarning)  # To prevent rasterio NotGeoreferencedWarning
 
@@ -99,7 +99,7 @@ def tile_from_xyz(root, x, y, z):
 
     assert len(path) == 1, "ambiguous tile path"
 
-    return mercantile.Tile(x, y, z), path[0]
+    return mercantile.Tile(int(x), int(y), int(z)), path[0]
 
 
 def tile_bbox(tile, mercator=False):
@@ -124,26 +124,255 @@ def tile_bbox(tile, mercator=False):
         assert False, "Unable to open tile"
 
 
-def tiles_to_geojson(tiles, union=True):
-    """Convert tiles to their footprint GeoJSON."""
+def tiles_to_array(tiles):
+    """Tiles, as a N,3 int64 array of x, y, z."""
 
-    first = True
-    geojson = '{"type":"FeatureCollection","features":['
+    if isinstance(tiles, np.ndarray):
+        return tiles.astype(np.int64, copy=False).reshape(-1, 3)
+
+    return np.array([(tile.x, tile.y, tile.z) for tile in tiles], dtype=np.int64).reshape(-1, 3)
+
+
+def tiles_from_array(array):
+    """Tiles, as a mercantile.Tile list, from a N,3 x, y, z array."""
+
+    return [mercantile.Tile(x, y, z) for x, y, z in array.tolist()]
+
+
+def tiles_keys(array):
+    """Tiles unique int64 keys, from a N,3 x, y, z array (z <= 29)."""
+
+    return (array[:, 2] << 58) | (array[:, 0] << 29) | array[:, 1]
+
+
+def tiles_from_keys(keys):
+    """N,3 x, y, z array, from tiles keys."""
+
+    mask = (1 << 29) - 1
+    return np.stack([(keys >> 29) & mask, keys & mask, keys >> 58], axis=1)
+
+
+def tiles_unique(array):
+    """Remove duplicate tiles, from a N,3 x, y, z array, keeping first occurrences order."""
+
+    _, index = np.unique(tiles_keys(array), return_index=True)
+    return array[np.sort(index)]
+
+
+def tiles_zoom(array, zoom):
+    """Tiles, from a N,3 x, y, z array, to zoom: parents with bit-shifts when zooming out, children when zooming in.
+    Input order is kept, children following their parent position, whatever the source zooms mix."""
+
+    levelled, sources = [], []
+    for z in np.unique(array[:, 2]).tolist():
+        index = np.flatnonzero(array[:, 2] == z)
+        tiles = array[index]
+
+        if z >= zoom:
+            xy = tiles[:, :2] >> (z - zoom)
+        else:
+            side = np.arange(1 << (zoom - z), dtype=np.int64)
+            offsets = np.stack(np.meshgrid(side, side, indexing="ij"), axis=-1).reshape(-1, 2)
+            xy = ((tiles[:, None, :2] << (zoom - z)) + offsets[None]).reshape(-1, 2)
+            index = np.repeat(index, len(offsets))
+
+        levelled.append(np.column_stack([xy, np.full(len(xy), zoom, dtype=np.int64)]))
+        sources.append(index)
+
+    if not levelled:
+        return array
+
+    order = np.argsort(np.concatenate(sources), kind="stable")  # back to input order, as zooms were grouped
+    return tiles_unique(np.concatenate(levelled)[order])
+
+
+def tiles_union(a, b):
+    """Tiles in a or in b, from N,3 x, y, z arrays."""
+
+    return tiles_unique(np.concatenate([a, b]))
+
+
+def tiles_intersection(a, b):
+    """Tiles both in a and in b, from N,3 x, y, z arrays."""
+
+    return tiles_unique(a[np.isin(tiles_keys(a), tiles_keys(b))])
+
+
+def tiles_difference(a, b):
+    """Tiles in a but not in b, from N,3 x, y, z arrays."""
+
+    return tiles_unique(a[~np.isin(tiles_keys(a), tiles_keys(b))])
+
+
+def tiles_dilate(array, k):
+    """Add to tiles, from a N,3 x, y, z array, their neighbours up to k tiles away (i.e (2k+1)² square)."""
+
+    side = np.arange(-k, k + 1, dtype=np.int64)
+    offsets = np.stack(np.meshgrid(side, side, indexing="ij"), axis=-1).reshape(-1, 2)
+
+    keys = [tiles_keys(array)]
+    for dx, dy in offsets.tolist():
+        x, y, z = array[:, 0] + dx, array[:, 1] + dy, array[:, 2]
+        inside = (x >= 0) & (y >= 0) & (x < (1 << z)) & (y < (1 << z))
+        keys.append((z[inside] << 58) | (x[inside] << 29) | y[inside])
+
+    keys = np.concatenate(keys)
+    _, index = np.unique(keys, return_index=True)
+    return tiles_from_keys(keys[np.sort(index)])
+
+
+def tiles_bounds(array):
+    """Tiles EPSG:4326 bounds, as a N,4 w, s, e, n array, from a N,3 x, y, z array."""
+
+    n = (1 << array[:, 2]).astype(np.float64)
+    x, y = array[:, 0].astype(np.float64), array[:, 1].astype(np.float64)
+
+    def lat(y):
+        return np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * y / n))))
+
+    return np.stack([x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)], axis=1)
+
+
+def tiles_to_polygons(array, band=256):
+    """Yield tiles footprints union, as EPSG:4326 shapely polygons arrays, from a N,3 x, y, z array.
+
+    Tiles are merged row-wise in run-length spans, identical spans on consecutive rows stacked in rectangles, and
+    rectangles unioned, in tiles coordinates, by bands of rows. Polygons touching a band bottom seam are carried over,
+    to be unioned with the next band ones touching it. So memory is bounded by a band, and its seam polygons.
+    """
+
+    for z in np.unique(array[:, 2]).tolist():
+        x, y = array[array[:, 2] == z][:, 0], array[array[:, 2] == z][:, 1]
+        order = np.lexsort((x, y))
+        x, y = x[order], y[order]
+
+        # Spans: consecutive tiles on a row. Those without any tile above or below are already polygons.
+        first = np.ones(len(x), dtype=bool)
+        first[1:] = (y[1:] != y[:-1]) | (x[1:] != x[:-1] + 1)
+        last = np.append(first[1:], True)
+        keys = (x << 29) | y
+        stacked = np.isin(keys - 1, keys) | np.isin(keys + 1, keys)
+        stacked = np.logical_or.reduceat(stacked, np.flatnonzero(first)) if len(x) else stacked
+        x0, x1, y0 = x[first], x[last], y[first]
+
+        n = 2 ** z
+
+        def lonlat(coords):
+            lon = coords[:, 0] / n * 360.0 - 180.0
+            lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * coords[:, 1] / n))))
+            return np.stack([lon, lat], axis=1)
+
+        boxes = shapely.box(x0[~stacked], y0[~stacked], x1[~stacked] + 1, y0[~stacked] + 1)
+        for i in range(0, len(boxes), 65536):
+            yield shapely.transform(boxes[i : i + 65536], lonlat)
+        x0, x1, y0 = x0[stacked], x1[stacked], y0[stacked]
+
+        # Rectangles: identical spans, on consecutive rows, in a same band
+        order = np.lexsort((y0, x1, x0, y0 // band))
+        x0, x1, y0 = x0[order], x1[order], y0[order]
+        first = np.ones(len(x0), dtype=bool)
+        first[1:] = (x0[1:] != x0[:-1]) | (x1[1:] != x1[:-1]) | (y0[1:] != y0[:-1] + 1) | (y0[1:] // band != y0[:-1] // band)
+        last = np.append(first[1:], True)
+        x0, x1, y0, y1 = x0[first], x1[last], y0[first], y0[last]
+
+        def union(boxes):
+            return shapely.simplify(shapely.get_parts(shapely.unary_union(boxes)), 0)  # exact: integer coordinates
+
+        carried = np.zeros(0, dtype=object)  # polygons touching previous band bottom seam
+        bands, starts = np.unique(y0 // band, return_index=True)
+        for b, start, end in zip(bands.tolist(), starts, np.append(starts[1:], len(x0))):
+            polygons = union(shapely.box(x0[start:end], y0[start:end], x1[start:end] + 1, y1[start:end] + 1))
+
+            if len(carried):
+                seam = shapely.bounds(polygons)[:, 1] == b * band
+                polygons = np.concatenate([polygons[~seam], union(np.concatenate([carried, polygons[seam]]))])
+
+            seam = shapely.bounds(polygons)[:, 3] == (b + 1) * band
+            carried = polygons[seam]
+            if (~seam).any():
+                yield shapely.transform(polygons[~seam], lonlat)
+
+        if len(carried):
+            yield shapely.transform(carried, lonlat)
+
+
+def tiles_to_features(tiles, union=True, batch_size=65536):
+    """Yield tiles footprint features batches, as (EPSG:4326 shapely geometries array, properties columns)."""
+
+    array = tiles_to_array(tiles)
 
     if union:  # smaller tiles union geometries (but losing properties)
-        tiles = [str(tile.z) + "-" + str(tile.x) + "-" + str(tile.y) + "\n" for tile in tiles]
-        for feature in supermercado.uniontiles.union(tiles, True):
-            geojson += json.dumps(feature) if first else "," + json.dumps(feature)
-            first = False
+        for polygons in tiles_to_polygons(tiles_unique(array)):
+            yield polygons, {}
     else:  # keep each tile geometry and properties (but fat)
-        for tile in tiles:
-            prop = '"properties":{{"x":{},"y":{},"z":{}}}'.format(tile.x, tile.y, tile.z)
-            geom = '"geometry":{}'.format(json.dumps(mercantile.feature(tile, precision=6)["geometry"]))
-            geojson += '{}{{"type":"Feature",{},{}}}'.format("," if not first else "", geom, prop)
+        for i in range(0, len(array), batch_size):
+            batch = array[i : i + batch_size]
+            columns = {"x": batch[:, 0].tolist(), "y": batch[:, 1].tolist(), "z": batch[:, 2].tolist()}
+            yield shapely.box(*tiles_bounds(batch).T), columns
+
+
+def tiles_to_geojson(tiles, union=True, fp=None):
+    """Convert tiles to their footprint GeoJSON. Streamed, chunk by chunk, if a file handle is provided, or returned."""
+
+    out = fp if fp is not None else io.StringIO()
+    out.write('{"type":"FeatureCollection","features":[')
+
+    first = True
+    for geometries, columns in tiles_to_features(tiles, union):
+        features = []
+        for i, geometry in enumerate(shapely.to_geojson(geometries).tolist()):
+            properties = json.dumps({k: v[i] for k, v in columns.items()})
+            features.append('{{"type":"Feature","geometry":{},"properties":{}}}'.format(geometry, properties))
+
+        if features:
+            out.write(",".join(features) if first else "," + ",".join(features))
             first = False
 
-    geojson += "]}"
-    return geojson
+    out.write("]}")
+    return out.getvalue() if fp is None else None
+
+
+def tiles_to_pyramid(tiles, root, chunk=6, top=4096):
+    """Write tiles coverage as a quadtree pyramid of static JSON files, to be loaded per viewport.
+
+    Levels are the tiles zoom (exact tiles), then coarser cells every 2 zoom levels, until at most top cells are left.
+    Each level cells, as [x, y, tiles count], are grouped in files by their parent cell chunk levels up, i.e
+    root/{level}/{x}/{y}.json, levels being described in root/index.json.
+    """
+
+    array = tiles_unique(tiles_to_array(tiles))
+    if not len(array):
+        return
+
+    zoom = int(array[:, 2].max())
+    array = tiles_zoom(array, zoom)
+    cells, counts, level, levels = array[:, :2], np.ones(len(array), dtype=np.int64), zoom, []
+
+    mask = (1 << 29) - 1
+    while True:
+        levels.append(level)
+
+        shift = min(chunk, level)
+        keys = ((cells[:, 0] >> shift) << 29) | (cells[:, 1] >> shift)
+        order = np.argsort(keys, kind="stable")
+        keys, rows = keys[order], np.column_stack([cells, counts])[order]
+        starts = np.flatnonzero(np.diff(keys, prepend=-1))
+        for key, group in zip(keys[starts].tolist(), np.split(rows, starts[1:])):
+            os.makedirs(os.path.join(root, str(level), str(key >> 29)), exist_ok=True)
+            with open(os.path.join(root, str(level), str(key >> 29), "{}.json".format(key & mask)), "w") as fp:
+                fp.write(json.dumps(group.tolist(), separators=(",", ":")))
+
+        if len(cells) <= top or not level:
+            break
+
+        step = min(2, level)
+        level -= step
+        keys, inverse = np.unique(((cells[:, 0] >> step) << 29) | (cells[:, 1] >> step), return_inverse=True)
+        cells = np.stack([keys >> 29, keys & mask], axis=1)
+        counts = np.bincount(inverse.ravel(), weights=counts, minlength=len(keys)).astype(np.int64)
+
+    with open(os.path.join(root, "index.json"), "w") as fp:
+        fp.write(json.dumps({"zoom": zoom, "levels": levels, "chunk": chunk, "tiles": len(array)}))
 
 
 def tiles_to_granules(tiles, pg):
@@ -154,15 +383,14 @@ def tiles_to_granules(tiles, pg):
     assert db
 
     granules = set()
-    tiles = [str(tile.z) + "-" + str(tile.x) + "-" + str(tile.y) + "\n" for tile in tiles]
-    for feature in supermercado.uniontiles.union(tiles, True):
-        geom = json.dumps(feature["geometry"])
-        query = """SELECT id FROM abd.s2_granules
-                   WHERE ST_Intersects(geom, ST_SetSRID(ST_GeomFromGeoJSON('{}'), 4326))""".format(
-            geom
-        )
-        db.execute(query)
-        granules.update(db.fetchone()[:])
+    for polygons in tiles_to_polygons(tiles_unique(tiles_to_array(tiles))):
+        for geom in shapely.to_geojson(polygons).tolist():
+            query = """SELECT id FROM abd.s2_granules
+                       WHERE ST_Intersects(geom, ST_SetSRID(ST_GeomFromGeoJSON('{}'), 4326))""".format(
+                geom
+            )
+            db.execute(query)
+            granules.update(db.fetchone()[:])
 
     return granules
 
@@ -265,14 +493,22 @@ def tile_label_to_file(root, tile, palette, transparency, label, append=False, m
         assert False, "Unable to write {}".format(path)
 
 
+def tile_image_from_bytes(data):
+    """Decode an encoded image (e.g PNG, JPEG, WEBP), and return it as RGB or None """
+
+    try:
+        return cv2.cvtColor(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_ANYCOLOR), cv2.COLOR_BGR2RGB)
+    except Exception:
+        return None
+
+
 def tile_image_from_url(requests_session, url, timeout=10):
     """Fetch a tile image using HTTP, and return it or None """
 
     try:
         resp = requests_session.get(url, timeout=timeout)
         resp.raise_for_status()
-        image = np.fromstring(io.BytesIO(resp.content).read(), np.uint8)
-        return cv2.cvtColor(cv2.imdecode(image, cv2.IMREAD_ANYCOLOR), cv2.COLOR_BGR2RGB)
+        return tile_image_from_bytes(resp.content)
 
     except Exception:
         return None
@@ -1,8 +1,8 @@
 import os
 import sys
-import json
 import torch
 import concurrent.futures as futures
+from functools import partial
 
 from PIL import Image
 from tqdm import tqdm
@@ -11,6 +11,7 @@ import numpy as np
 from mercantile import feature
 
 from abd_model.core import web_ui, Logs, load_module, load_config
+from abd_model.vector import VectorWriter
 from abd_model.tiles import tiles_from_dir, tile_from_xyz, tiles_from_csv, tile_image_from_file, tile_image_to_file
 
 
@@ -42,7 +43,8 @@ def add_parser(subparser, formatter_class):
 
     out = parser.add_argument_group("Outputs")
     out.add_argument("--vertical", action="store_true", help="output vertical image aggregate [optionnal for side mode]")
-    out.add_argument("--geojson", action="store_true", help="output results as GeoJSON [optionnal for list mode]")
+    help = "output results as vector features, format from --out extension [optionnal for list mode]"
+    out.add_argument("--geojson", action="store_true", help=help)
     out.add_argument("--format", type=str, default="webp", help="output images file format [default: webp]")
     out.add_argument("--out", type=str, help="output path")
 
@@ -54,6 +56,60 @@ def add_parser(subparser, formatter_class):
     parser.set_defaults(func=main)
 
 
+def tile_metrics(label, mask, minmax):
+    """Compute, vectorized, asked metrics on a label/mask pair, from per class confusion counts."""
+
+    classes = sorted(set([mm["class_id"] for mm in minmax.values()]))
+    expected = label[np.newaxis] == np.array(classes).reshape(-1, 1, 1)
+    predicted = mask[np.newaxis] == np.array(classes).reshape(-1, 1, 1)
+
+    code = expected.astype(np.int64) * 2 + predicted + np.arange(len(classes)).reshape(-1, 1, 1) * 4
+    counts = np.bincount(code.ravel(), minlength=len(classes) * 4).reshape(-1, 4)  # tn, fp, fn, tp
+    counts = torch.from_numpy(counts[:, [0, 2, 1, 3]])
+
+    metrics = dict()
+    for mm, spec in minmax.items():
+        tn, fn, fp, tp = counts[classes.index(spec["class_id"])]
+        metrics[mm] = float(load_module("abd_model.metrics." + spec["metric"]).get_from_confusion(tn, fn, fp, tp))
+
+    return metrics
+
+
+def worker_metrics(labels, masks, minmax, tile):
+    x, y, z = list(map(str, tile))
+
+    label = np.array(Image.open(os.path.join(labels, z, x, "{}.png".format(y))))
+    mask = np.array(Image.open(os.path.join(masks, z, x, "{}.png".format(y))))
+    assert label.shape == mask.shape, "Inconsistent tiles (size or dimensions)"
+
+    try:
+        return tile, tile_metrics(label, mask, minmax)
+    except:
+        return tile, None  # to be logged, and skipped
+
+
+def list_writer(path, geojson, minmax):
+    if geojson:
+        return VectorWriter(path, dict([("x", "int"), ("y", "int"), ("z", "int")] + [(str(mm), "float") for mm in minmax]))
+
+    return open(path, mode="w")
+
+
+def write_list_tile(out, geojson, tile, metrics):
+    x, y, z = list(map(str, tile))
+
+    if geojson:
+        properties = dict([("x", tile.x), ("y", tile.y), ("z", tile.z)])
+        properties.update({str(mm): round(value, 3) for mm, value in metrics.items()})
+        out.write(feature(tile, precision=6)["geometry"], properties)
+
+    if not geojson:
+        out.write("{},{},{}".format(x, y, z))
+        for metric in metrics:
+            out.write("\t{:.3f}".format(metrics[metric]))
+        out.write(os.linesep)
+
+
 def main(args):
 
     if not args.masks or not args.labels:
@@ -76,11 +132,12 @@ def main(args):
         mm_min = float(args.min[mm]) if mm in args.min else 0.0
         mm_max = float(args.max[mm]) if mm in args.max else 1.0
         assert mm_min < mm_max, "--min must be lower than --max, on {}".format(mm)
+        load_module("abd_model.metrics." + mm[1])  # fail early, on unknown metric
         minmax[mm] = {
             "min": mm_min,
             "max": mm_max,
             "class_id": [c for c, classe in enumerate(config["classes"]) if classe["title"] == mm[0]][0],
-            "module": load_module("abd_model.metrics." + mm[1]),
+            "metric": mm[1],
         }
 
     if not args.workers:
@@ -106,111 +163,77 @@ def main(args):
             assert sorted(tiles_masks) == sorted(tiles_labels), "Label and Mask directories are not consistent"
             tiles = tiles_masks
 
-    tiles_list = []
-    tiles_compare = []
-    progress = tqdm(total=len(tiles), ascii=True, unit="tile")
+    tiles_compare = tiles
     log = False if args.mode == "list" else Logs(os.path.join(args.out, "log"))
+    if args.mode == "list" or minmax:
+        tiles_compare = []
+        out = list_writer(args.out, args.geojson, minmax) if args.mode == "list" else None
 
-    with futures.ThreadPoolExecutor(args.workers) as executor:
-
-        def worker(tile):
-            x, y, z = list(map(str, tile))
-
-            if args.masks and args.labels:
-
-                label = np.array(Image.open(os.path.join(args.labels, z, x, "{}.png".format(y))))
-                mask = np.array(Image.open(os.path.join(args.masks, z, x, "{}.png".format(y))))
-
-                assert label.shape == mask.shape, "Inconsistent tiles (size or dimensions)"
-
-                metrics = dict()
-                for mm in minmax:
-                    try:
-                        metrics[mm] = getattr(minmax[mm]["module"], "get")(
-                            torch.as_tensor(label, device="cpu"),
-                            torch.as_tensor(mask, device="cpu"),
-                            minmax[mm]["class_id"],
-                        )
-                    except:
-                        progress.update()
-                        return False, tile
+        with futures.ProcessPoolExecutor(args.workers) as executor:
+            worker = partial(worker_metrics, args.labels, args.masks, minmax)
+            chunksize = max(1, min(256, len(tiles) // (args.workers * 4)))
+            results = executor.map(worker, tiles, chunksize=chunksize)  # ordered, streamed as completed
 
-                    if not (minmax[mm]["min"] <= metrics[mm] <= minmax[mm]["max"]):
-                        progress.update()
-                        return True, tile
+            for tile, metrics in tqdm(results, desc="Metrics", total=len(tiles), ascii=True, unit="tile"):
+                if metrics is None:
+                    if log:
+                        log.log("Warning: skipping. {}".format(str(tile)))
+                    continue
 
-            tiles_compare.append(tile)
+                if not all([minmax[mm]["min"] <= metrics[mm] <= minmax[mm]["max"] for mm in minmax]):
+                    continue  # NaN metrics never match
 
-            if args.mode == "side":
-                for i, root in enumerate(args.images):
-                    img = tile_image_from_file(tile_from_xyz(root, x, y, z)[1], force_rgb=True)
+                if out:
+                    write_list_tile(out, args.geojson, tile, metrics)
+                tiles_compare.append(tile)
 
-                    if i == 0:
-                        side = np.zeros((img.shape[0], img.shape[1] * len(args.images), 3))
-                        side = np.swapaxes(side, 0, 1) if args.vertical else side
-                        image_shape = img.shape
-                    else:
-                        assert image_shape[0:2] == img.shape[0:2], "Unconsistent image size to compare"
-
-                    if args.vertical:
-                        side[i * image_shape[0] : (i + 1) * image_shape[0], :, :] = img
-                    else:
-                        side[:, i * image_shape[0] : (i + 1) * image_shape[0], :] = img
-
-                tile_image_to_file(args.out, tile, np.uint8(side))
-
-            elif args.mode == "stack":
-                for i, root in enumerate(args.images):
-                    tile_image = tile_image_from_file(tile_from_xyz(root, x, y, z)[1], force_rgb=True)
+        if out:
+            out.close()
 
-                    if i == 0:
-                        image_shape = tile_image.shape[0:2]
-                        stack = tile_image / len(args.images)
-                    else:
-                        assert image_shape == tile_image.shape[0:2], "Unconsistent image size to compare"
-                        stack = stack + (tile_image / len(args.images))
+    if args.mode in ["side", "stack"]:
+        progress = tqdm(total=len(tiles_compare), ascii=True, unit="tile")
 
-                tile_image_to_file(args.out, tile, np.uint8(stack))
+        with futures.ThreadPoolExecutor(args.workers) as executor:
 
-            elif args.mode == "list":
-                tiles_list.append([tile, metrics])
+            def worker(tile):
+                x, y, z = list(map(str, tile))
 
-            progress.update()
-            return True, tile
+                if args.mode == "side":
+                    for i, root in enumerate(args.images):
+                        img = tile_image_from_file(tile_from_xyz(root, x, y, z)[1], force_rgb=True)
 
-        for ok, tile in executor.map(worker, tiles):
-            if not ok and log:
-                log.log("Warning: skipping. {}".format(str(tile)))
+                        if i == 0:
+                            side = np.zeros((img.shape[0], img.shape[1] * len(args.images), 3))
+                            side = np.swapaxes(side, 0, 1) if args.vertical else side
+                            image_shape = img.shape
+                        else:
+                            assert image_shape[0:2] == img.shape[0:2], "Unconsistent image size to compare"
 
-    if args.mode == "list":
-        with open(args.out, mode="w") as out:
+                        if args.vertical:
+                            side[i * image_shape[0] : (i + 1) * image_shape[0], :, :] = img
+                        else:
+                            side[:, i * image_shape[0] : (i + 1) * image_shape[0], :] = img
 
-            if args.geojson:
-                out.write('{"type":"FeatureCollection","features":[')
-                first = True
+                    tile_image_to_file(args.out, tile, np.uint8(side))
 
-            for tile_list in tiles_list:
-                tile, metrics = tile_list
-                x, y, z = list(map(str, tile))
+                elif args.mode == "stack":
+                    for i, root in enumerate(args.images):
+                        tile_image = tile_image_from_file(tile_from_xyz(root, x, y, z)[1], force_rgb=True)
 
-                if args.geojson:
-                    prop = '"properties":{{"x":{},"y":{},"z":{}'.format(x, y, z)
-                    for metric in metrics:
-                        prop += ',"{}":{:.3f}'.format(metric, metrics[metric])
-                    geom = '"geometry":{}'.format(json.dumps(feature(tile, precision=6)["geometry"]))
-                    out.write('{}{{"type":"Feature",{},{}}}}}'.format("," if not first else "", geom, prop))
-                    first = False
+                        if i == 0:
+                            image_shape = tile_image.shape[0:2]
+                            stack = tile_image / len(args.images)
+                        else:
+                            assert image_shape == tile_image.shape[0:2], "Unconsistent image size to compare"
+                            stack = stack + (tile_image / len(args.images))
 
-                if not args.geojson:
-                    out.write("{},{},{}".format(x, y, z))
-                    for metric in metrics:
-                        out.write("\t{:.3f}".format(metrics[metric]))
-                    out.write(os.linesep)
+                    tile_image_to_file(args.out, tile, np.uint8(stack))
 
-            if args.geojson:
-                out.write("]}")
+                progress.update()
+                return tile
 
-            out.close()
+            for tile in executor.map(worker, tiles_compare):
+                pass
 
     base_url = args.web_ui_base_url if args.web_ui_base_url else "."
 
@@ -1,19 +1,21 @@
 import os
 import sys
 import csv
-import json
 import math
 import psycopg2
-import collections
+import shapely
 
+import numpy as np
 from tqdm import tqdm
-from random import shuffle
-from mercantile import tiles, xy_bounds
+from mercantile import Tile, tiles
 from rasterio import open as rasterio_open
 from rasterio.warp import transform_bounds
 
-from abd_model.tiles import tiles_from_dir, tiles_from_csv, tiles_to_geojson
-from abd_model.geojson import geojson_srid, geojson_parse_feature
+from abd_model.tiles import tiles_from_dir, tiles_from_csv, tiles_to_features, tiles_to_array
+from abd_model.tiles import tiles_zoom, tiles_unique, tiles_union, tiles_intersection, tiles_difference, tiles_dilate
+from abd_model.tiles import tiles_bounds
+from abd_model.vector import VectorWriter, read_vector, vector_srid
+from abd_model.geojson import geojson_polygons, polygons_tiles
 
 
 def add_parser(subparser, formatter_class):
@@ -24,20 +26,26 @@ def add_parser(subparser, formatter_class):
     inp = parser.add_argument_group("Input [one among the following is required]")
     inp.add_argument("--dir", type=str, help="plain tiles dir path")
     inp.add_argument("--bbox", type=str, help="a lat/lon bbox: xmin,ymin,xmax,ymax or a bbox: xmin,xmin,xmax,xmax,EPSG:xxxx")
-    inp.add_argument("--geojson", type=str, nargs="+", help="path to GeoJSON features files")
-    inp.add_argument("--cover", type=str, help="a cover file path")
+    help = "path to features files, format from extension (e.g .geojson .geojsonl .fgb .gpkg .parquet)"
+    inp.add_argument("--geojson", type=str, nargs="+", help=help)
+    inp.add_argument("--cover", type=str, nargs="+", help="cover file paths, combined with --operation if several")
     inp.add_argument("--raster", type=str, nargs="+", help="a raster file path")
     inp.add_argument("--sql", type=str, help="SQL to retrieve geometry features (e.g SELECT geom FROM a_table)")
 
     db = parser.add_argument_group("Spatial DataBase [required with --sql input]")
     db.add_argument("--pg", type=str, help="PostgreSQL dsn using psycopg2 syntax (e.g 'dbname=db user=postgres')")
 
+    ops = parser.add_argument_group("Cover operations")
+    help = "operation to combine several --cover inputs, after --zoom levelling if any [default: union]"
+    ops.add_argument("--operation", type=str, choices=["union", "intersection", "difference"], default="union", help=help)
+    ops.add_argument("--dilate", type=int, help="if set, add to cover tiles their neighbours, up to k tiles away")
+
     tile = parser.add_argument_group("Tiles")
     tile.add_argument("--no_xyz", action="store_true", help="if set, tiles are not expected to be XYZ based.")
 
     out = parser.add_argument_group("Outputs")
     out.add_argument("--zoom", type=int, help="zoom level of tiles [required, except with --dir or --cover inputs]")
-    help = "Output type (default: cover)"
+    help = "Output type, geojson one in --out extension format (e.g .geojson .fgb .gpkg .parquet) [default: cover]"
     out.add_argument("--crs", type=str, help="CRS of input rasters")
     out.add_argument("--type", type=str, choices=["cover", "extent", "geojson"], default="cover", help=help)
     out.add_argument("--union", action="store_true", help="if set, union adjacent tiles, imply --type geojson")
@@ -47,6 +55,13 @@ def add_parser(subparser, formatter_class):
     parser.set_defaults(func=main)
 
 
+def polygons_cover(polygons, zoom):
+    """Return the set of tiles, at zoom, covered by EPSG:4326 polygons."""
+
+    _, xs, ys = polygons_tiles(polygons, zoom)
+    return set(Tile(x, y, zoom) for x, y in zip(xs.tolist(), ys.tolist()))
+
+
 def main(args):
 
     assert not (args.type == "extent" and args.splits), "--splits and --type extent are mutually exclusive options"
@@ -94,44 +109,63 @@ def main(args):
 
     if args.geojson:
         print("abd cover from {} at zoom {}".format(args.geojson, args.zoom), file=sys.stderr, flush=True)
-        feature_map = collections.defaultdict(list)
+        cover = set()
         for geojson_file in args.geojson:
-            with open(os.path.expanduser(geojson_file)) as f:
-                feature_collection = json.load(f)
-                srid = geojson_srid(feature_collection)
-
-                for feature in tqdm(feature_collection["features"], ascii=True, unit="feature"):
-                    feature_map = geojson_parse_feature(args.zoom, srid, feature_map, feature)
+            srid = vector_srid(geojson_file)
+            progress = tqdm(desc=os.path.basename(geojson_file), ascii=True, unit="feature")
+            for geometries, _ in read_vector(geojson_file):  # bounded memory: cover is updated batch by batch
+                polygons = [polygon for geometry in geometries for polygon in geojson_polygons(srid, geometry)]
+                cover.update(polygons_cover(polygons, args.zoom))
+                progress.update(len(geometries))
+            progress.close()
 
-        cover = feature_map.keys()
+        cover = list(cover)
 
     if args.sql:
         print("abd cover from {} {} at zoom {}".format(args.sql, args.pg, args.zoom), file=sys.stderr, flush=True)
         conn = psycopg2.connect(args.pg)
         assert conn, "Unable to connect to PostgreSQL database."
-        db = conn.cursor()
 
+        # Tiles are computed server side, from EPSG:3857 bounds, for polygons lying on a single tile (i.e most of
+        # them). Only polygons spanning several tiles are sent, as EPSG:4326 WKB, to be indexed client side.
+        size = 2 * 20037508.342789244 / 2 ** args.zoom
+        tile = "Greatest(Least({}, {}), 0)::int".format("{}", 2 ** args.zoom - 1)
         query = """
             WITH
               sql  AS ({}),
-              geom AS (SELECT "1" AS geom FROM sql AS t("1"))
-              SELECT '{{"type": "Feature", "geometry": '
-                     || ST_AsGeoJSON((ST_Dump(ST_Transform(ST_Force2D(geom.geom), 4326))).geom, 6)
-                     || '}}' AS features
-              FROM geom
+              geom AS (SELECT (ST_Dump(ST_Force2D("1"))).geom AS geom FROM sql AS t("1")),
+              bbox AS (SELECT geom, Box2D(ST_Transform(geom, 3857)) AS b FROM geom WHERE GeometryType(geom) = 'POLYGON'),
+              tile AS (
+                SELECT geom, {} AS x0, {} AS x1, {} AS y0, {} AS y1
+                FROM bbox
+              )
+              SELECT x0, y0, CASE WHEN x1 > x0 OR y1 > y0 THEN ST_AsBinary(ST_Transform(geom, 4326)) END AS wkb
+              FROM tile
             """.format(
-            args.sql
+            args.sql,
+            tile.format("floor((ST_XMin(b) + 20037508.342789244) / {})".format(size)),
+            tile.format("ceil((ST_XMax(b) + 20037508.342789244) / {}) - 1".format(size)),
+            tile.format("floor((20037508.342789244 - ST_YMax(b)) / {})".format(size)),
+            tile.format("ceil((20037508.342789244 - ST_YMin(b)) / {}) - 1".format(size)),
         )
 
-        db.execute(query)
-        assert db.rowcount is not None and db.rowcount != -1, "SQL Query return no result."
-
-        feature_map = collections.defaultdict(list)
-
-        for feature in tqdm(db.fetchall(), ascii=True, unit="feature"):  # FIXME: fetchall will not always fit in memory...
-            feature_map = geojson_parse_feature(args.zoom, 4326, feature_map, json.loads(feature[0]))
+        cover = set()
+        progress = tqdm(ascii=True, unit="feature")
+        with conn.cursor(name="abd_cover") as db:  # server-side cursor: rows are streamed, batch by batch
+            db.execute(query)
+            while True:
+                rows = db.fetchmany(65536)
+                if not rows:
+                    break
+
+                cover.update([Tile(x, y, args.zoom) for x, y, wkb in rows if wkb is None])
+                polygons = shapely.from_wkb([bytes(wkb) for x, y, wkb in rows if wkb is not None])
+                cover.update(polygons_cover(polygons, args.zoom))
+                progress.update(len(rows))
+        progress.close()
+        conn.close()
 
-        cover = feature_map.keys()
+        cover = list(cover)
 
     if args.bbox:
         try:
@@ -150,7 +184,12 @@ def main(args):
 
     if args.cover:
         print("abd cover from {}".format(args.cover), file=sys.stderr, flush=True)
-        cover = [tile for tile in tiles_from_csv(os.path.expanduser(args.cover))]
+        covers = [tiles_to_array(tiles_from_csv(os.path.expanduser(path))) for path in args.cover]
+        covers = [tiles_zoom(cover, args.zoom) if args.zoom else cover for cover in covers]
+        operation = {"union": tiles_union, "intersection": tiles_intersection, "difference": tiles_difference}
+        cover = tiles_unique(covers[0])
+        for other in covers[1:]:
+            cover = operation[args.operation](cover, other)
 
     if args.dir:
         print("abd cover from {}".format(args.dir), file=sys.stderr, flush=True)
@@ -158,30 +197,19 @@ def main(args):
 
     assert len(cover), "Empty tiles inputs"
 
-    _cover = []
-    extent_w, extent_s, extent_n, extent_e = (180.0, 90.0, -180.0, -90.0)
-    for tile in tqdm(cover, ascii=True, unit="tile"):
-        if args.zoom and tile.z != args.zoom:
-            w, s, n, e = transform_bounds("EPSG:3857", "EPSG:4326", *xy_bounds(tile))
-            for t in tiles(w, s, n, e, args.zoom):
-                unique = True
-                for _t in _cover:
-                    if _t == t:
-                        unique = False
-                if unique:
-                    _cover.append(t)
-        else:
-            if args.type == "extent":
-                w, s, n, e = transform_bounds("EPSG:3857", "EPSG:4326", *xy_bounds(tile))
-            _cover.append(tile)
+    cover = tiles_to_array(cover)
+    if args.type == "extent":
+        bounds = tiles_bounds(cover)
+        extent_w, extent_s, extent_e, extent_n = (*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0))
 
-        if args.type == "extent":
-            extent_w, extent_s, extent_n, extent_e = (min(extent_w, w), min(extent_s, s), max(extent_n, n), max(extent_e, e))
+    if args.zoom:
+        cover = tiles_zoom(cover, args.zoom)
 
-    cover = _cover
+    if args.dilate:
+        cover = tiles_dilate(cover, args.dilate)
 
     if args.splits:
-        shuffle(cover)  # in-place
+        cover = cover[np.random.permutation(len(cover))]
         cover_splits = [math.floor(len(cover) * split / 100) for i, split in enumerate(splits, 1)]
         if len(splits) > 1 and sum(map(int, splits)) == 100 and len(cover) > sum(map(int, splits)):
             cover_splits[0] = len(cover) - sum(map(int, cover_splits[1:]))  # no tile waste
@@ -194,7 +222,7 @@ def main(args):
         covers = [cover]
 
     if args.type == "extent":
-        extent = "{:.8f},{:.8f},{:.8f},{:.8f}".format(extent_w, extent_s, extent_n, extent_e)
+        extent = "{:.8f},{:.8f},{:.8f},{:.8f}".format(extent_w, extent_s, extent_e, extent_n)
 
         if args.out:
             if os.path.dirname(args.out[0]) and not os.path.isdir(os.path.dirname(args.out[0])):
@@ -210,8 +238,11 @@ def main(args):
             if os.path.dirname(args.out[i]) and not os.path.isdir(os.path.dirname(args.out[i])):
                 os.makedirs(os.path.dirname(args.out[i]), exist_ok=True)
 
-            with open(args.out[i], "w") as fp:
-                if args.type == "geojson":
-                    fp.write(tiles_to_geojson(cover, union=args.union))
-                else:
-                    csv.writer(fp).writerows(cover)
+            if args.type == "geojson":
+                properties = {} if args.union else {"x": "int", "y": "int", "z": "int"}
+                with VectorWriter(args.out[i], properties) as out:
+                    for geometries, columns in tiles_to_features(cover, union=args.union):
+                        out.write_batch(geometries, columns)
+            else:
+                with open(args.out[i], "w") as fp:
+                    csv.writer(fp).writerows(cover.tolist())
@@ -1,9 +1,10 @@
 import os
 import sys
-import torch
 import numpy as np
 from tqdm import tqdm
-from torch.utils.data import DataLoader
+from functools import partial
+import concurrent.futures as futures
+
 from abd_model.core import load_config, check_classes, check_channels
 from abd_model.tiles import tiles_from_dir, tile_label_from_file, tiles_from_csv
 
@@ -16,39 +17,143 @@ def add_parser(subparser, formatter_class):
     parser.add_argument("--cover", type=str, help="path to csv tiles cover file, to filter tiles dataset on [optional]")
     parser.add_argument("--workers", type=int, help="number of workers [default: CPU]")
 
-    choices = ["check", "weights"]
-    parser.add_argument("--mode", type=str, default="check", choices=choices, help="dataset mode [default: check]")
+    choices = ["check", "weights", "histograms"]
+    help = "dataset mode, histograms (re)compute labels classes histograms sidecar [default: check]"
+    parser.add_argument("--mode", type=str, default="check", choices=choices, help=help)
     parser.set_defaults(func=main)
 
 
-class LabelsDataset(torch.utils.data.Dataset):
-    def __init__(self, root, num_classes, cover=None):
-        super().__init__()
-        self.num_classes = num_classes
-        self.tiles = [path for tile, path in tiles_from_dir(os.path.join(root, "labels"), cover=cover, xyz_path=True)]
-        assert len(self.tiles), "Empty Dataset"
+#
+# Labels classes histograms sidecar
+#
+def histograms_path(dataset):
+    return os.path.join(os.path.expanduser(dataset), "labels_histograms.npz")
+
+
+def worker_histogram(num_classes, path):
+    label = tile_label_from_file(path)
+    return np.bincount(label.ravel(), minlength=num_classes) if label is not None else None
+
+
+def compute_histograms(paths, num_classes, workers):
+    """Compute, in parallel, labels tiles classes pixels histograms. Return them as (N,C) counts."""
+
+    with futures.ProcessPoolExecutor(workers) as executor:
+        histograms = list(
+            tqdm(
+                executor.map(partial(worker_histogram, num_classes), paths, chunksize=64),
+                desc="Labels Histograms",
+                total=len(paths),
+                unit="tile",
+                ascii=True,
+            )
+        )
+
+    unreadable = [path for path, histogram in zip(paths, histograms) if histogram is None]
+    assert not unreadable, "Unable to open labels: {}".format(", ".join(unreadable[:10]))
+
+    width = max([len(histogram) for histogram in histograms] + [num_classes])  # wider, on labels with invalid values
+    counts = np.zeros((len(paths), width), dtype=np.uint32)
+    for i, histogram in enumerate(histograms):
+        counts[i, : len(histogram)] = histogram
+
+    return counts
+
+
+def load_histograms(dataset, num_classes, cover=None, workers=None, force=False):
+    """Return labels tiles, and their classes histograms (N,C), from sidecar.
+
+    Histograms of labels new or edited since (i.e with another modification time or size) are computed first,
+    and the sidecar updated. All of them, if force, or if the sidecar is missing or unreadable.
+    """
+
+    tiles = sorted(tiles_from_dir(os.path.join(os.path.expanduser(dataset), "labels"), xyz_path=True))
+    assert len(tiles), "Empty Dataset labels"
+
+    paths = [path for tile, path in tiles]
+    tiles = [tile for tile, path in tiles]
+    stats = [os.stat(path) for path in paths]
+    mtimes = np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64)
+    sizes = np.array([stat.st_size for stat in stats], dtype=np.int64)
 
-    def __len__(self):
-        return len(self.tiles)
+    try:
+        assert not force
+        sidecar = np.load(histograms_path(dataset))
+        cached = {xyz: i for i, xyz in enumerate(zip(sidecar["x"].tolist(), sidecar["y"].tolist(), sidecar["z"].tolist()))}
+        rows = np.array([cached.get((tile.x, tile.y, tile.z), -1) for tile in tiles], dtype=np.int64)
+        stale = (rows == -1) | (sidecar["mtime"][rows] != mtimes) | (sidecar["size"][rows] != sizes)
+        removed = len(cached) - int((rows != -1).sum())
+        counts = sidecar["counts"][rows]
+        assert counts.shape[1] >= num_classes
+    except (OSError, KeyError, ValueError, IndexError, AssertionError):
+        stale, removed, counts = np.ones(len(tiles), dtype=bool), 0, np.zeros((len(tiles), num_classes), dtype=np.uint32)
 
-    def __getitem__(self, i):
-        mask = torch.from_numpy(tile_label_from_file(self.tiles[i]))
-        return torch.bincount(mask.view(-1), minlength=self.num_classes), mask.nelement()
+    if stale.any():
+        fresh = compute_histograms([path for path, s in zip(paths, stale) if s], num_classes, workers or os.cpu_count())
+        if fresh.shape[1] > counts.shape[1]:
+            counts = np.pad(counts, ((0, 0), (0, fresh.shape[1] - counts.shape[1])))
+        counts[stale] = 0
+        counts[stale, : fresh.shape[1]] = fresh
+
+    if stale.any() or removed:
+        xyz = np.array(tiles, dtype=np.uint32).reshape(-1, 3)
+        path = histograms_path(dataset)
+        with open(path + ".tmp", "wb") as fp:
+            np.savez_compressed(fp, x=xyz[:, 0], y=xyz[:, 1], z=xyz[:, 2], mtime=mtimes, size=sizes, counts=counts)
+        os.replace(path + ".tmp", path)
+
+    if cover is not None:
+        cover = set(cover)
+        keep = np.array([tile in cover for tile in tiles], dtype=bool)
+        tiles = [tile for tile, k in zip(tiles, keep) if k]
+        counts = counts[keep]
+
+    return tiles, counts
 
 
 def compute_classes_weights(dataset, classes, cover, workers):
-    label_dataset = LabelsDataset(dataset, len(classes), cover)
-    loader = DataLoader(label_dataset, batch_size=workers, num_workers=workers)
-    n_classes = np.zeros(len(classes))
-    n_pixels = 0
-    for c, n in tqdm(loader, desc="Classes Weights", unit="batch", ascii=True):
-        n_classes += c.data.numpy()[0]
-        n_pixels += int(n.data.numpy()[0])
+    tiles, counts = load_histograms(dataset, len(classes), cover, workers)
+    assert len(tiles), "Empty Dataset"
+
+    n_classes = counts[:, : len(classes)].sum(axis=0, dtype=np.float64)
+    n_pixels = counts.sum(dtype=np.float64)
 
     weights = 1 / np.log(1.02 + (n_classes / n_pixels))  # cf https://arxiv.org/pdf/1606.02147.pdf
     return weights.round(3, out=weights).tolist()
 
 
+def check_dataset(dataset, config, cover, workers):
+    """Check dataset labels consistency, against classes and channels. Return a list of errors."""
+
+    errors = []
+    num_classes = len(config["classes"])
+    tiles, counts = load_histograms(dataset, num_classes, cover, workers)
+
+    invalid = np.flatnonzero(counts[:, num_classes:].sum(axis=1)) if counts.shape[1] > num_classes else []
+    for i in invalid[:10]:
+        errors.append("Label {} with values beyond {} classes".format(tiles[i], num_classes))
+    if len(invalid) > 10:
+        errors.append("... and {} others labels with values beyond classes".format(len(invalid) - 10))
+
+    sizes, sizes_count = np.unique(counts.sum(axis=1), return_counts=True)
+    if len(sizes) > 1:
+        errors.append("Inconsistent labels sizes (in pixels): {}".format(dict(zip(sizes.tolist(), sizes_count.tolist()))))
+
+    for channel in config["channels"]:
+        images = set(tiles_from_dir(os.path.join(os.path.expanduser(dataset), channel["name"]), cover=cover))
+        missing = [tile for tile in tiles if tile not in images]
+        if missing:
+            errors.append("{} labels without {} image, e.g: {}".format(len(missing), channel["name"], missing[:3]))
+        orphans = len(images) - (len(tiles) - len(missing))
+        if orphans:
+            errors.append("{} {} images without label".format(orphans, channel["name"]))
+
+    empty = int((counts[:, 1:].sum(axis=1) == 0).sum())
+    print("{} labels tiles, {} ({:.1%}) background only".format(len(tiles), empty, empty / len(tiles)), file=sys.stderr)
+
+    return errors
+
+
 def main(args):
 
     assert os.path.isdir(os.path.expanduser(args.dataset)), "--dataset path is not a directory"
@@ -64,9 +169,17 @@ def main(args):
         check_classes(config)
         check_channels(config)
 
-        # TODO check dataset
+        errors = check_dataset(args.dataset, config, args.cover, args.workers)
+        for error in errors:
+            print("ERROR: {}".format(error), file=sys.stderr)
+        assert not errors, "Dataset inconsistencies found"
 
     if args.mode == "weights":
         check_classes(config)
         weights = compute_classes_weights(args.dataset, config["classes"], args.cover, args.workers)
         print(",".join(map(str, weights)))
+
+    if args.mode == "histograms":
+        check_classes(config)
+        tiles, counts = load_histograms(args.dataset, len(config["classes"]), workers=args.workers, force=True)
+        print("{} labels histograms saved in {}".format(len(tiles), histograms_path(args.dataset)), file=sys.stderr)
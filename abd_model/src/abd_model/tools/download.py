@@ -1,14 +1,18 @@
 import os
 import sys
-import time
+import random
+import asyncio
+import collections
 import concurrent.futures as futures
 
-import requests
+import cv2
+import numpy as np
 from tqdm import tqdm
 from mercantile import xy_bounds
 
 from abd_model.core import web_ui, Logs
-from abd_model.tiles import tiles_from_csv, tile_image_from_url, tile_image_to_file
+from abd_model.fetch import fetch_all
+from abd_model.tiles import tiles_from_csv
 
 
 def add_parser(subparser, formatter_class):
@@ -22,13 +26,20 @@ def add_parser(subparser, formatter_class):
     ws.add_argument("--type", type=str, default="XYZ", choices=["XYZ", "WMS"], help="service type [default: XYZ]")
     ws.add_argument("--rate", type=int, default=10, help="download rate limit in max requests/seconds [default: 10]")
     ws.add_argument("--timeout", type=int, default=10, help="download request timeout (in seconds) [default: 10]")
-    ws.add_argument("--workers", type=int, help="number of workers [default: same as --rate value]")
+    ws.add_argument("--workers", type=int, help="number of concurrent requests [default: same as --rate value]")
+    help = "max number of concurrent requests on a same host [default: same as --workers value]"
+    ws.add_argument("--host_workers", type=int, help=help)
+    help = "number of retries, with exponential backoff, on network or server errors [default: 3]"
+    ws.add_argument("--retries", type=int, default=3, help=help)
 
     cover = parser.add_argument_group("Coverage to download")
     cover.add_argument("--cover", type=str, required=True, help="path to .csv tiles list [required]")
 
     out = parser.add_argument_group("Output")
-    out.add_argument("--format", type=str, default="webp", help="file format to save images in [default: webp]")
+    help = "file format to save images in, those already in it being written as downloaded [default: webp]"
+    out.add_argument("--format", type=str, default="webp", help=help)
+    help = "ratio of images written as downloaded, decoded anyway to check them [default: 0.01]"
+    out.add_argument("--check", type=float, default=0.01, help=help)
     out.add_argument("--out", type=str, required=True, help="output directory path [required]")
 
     ui = parser.add_argument_group("Web UI")
@@ -39,74 +50,145 @@ def add_parser(subparser, formatter_class):
     parser.set_defaults(func=main)
 
 
+def image_format(data):
+    """Encoded image format, from its magic bytes, or None."""
+
+    if data is None:
+        return None
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:4] in [b"II*\x00", b"MM\x00*"]:
+        return "tiff"
+    return None
+
+
+def temporary(path):
+    """Hidden path, in the same dir, to write a tile before an atomic rename (i.e never a partial tile)."""
+
+    return os.path.join(os.path.dirname(path), "." + os.path.basename(path))
+
+
+def write_bytes(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(temporary(path), "wb") as fp:
+        fp.write(data)
+    os.replace(temporary(path), path)
+
+
+def worker_convert(path, data):
+    """Decode a downloaded image, and write it in path extension format. Return True if ok."""
+
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not cv2.imwrite(temporary(path), image):
+        return False
+    os.replace(temporary(path), path)
+    return True
+
+
+def worker_check(path):
+    """Decode a written image, and remove it if invalid. Return True if ok."""
+
+    if cv2.imread(path, cv2.IMREAD_UNCHANGED) is not None:
+        return True
+
+    os.remove(path)
+    return False
+
+
+async def download(args, tiles, progress):
+    """Download tiles, fetched asynchronously. Images already in the output format are written as downloaded, in a
+    threads pool, others converted, in a processes pool, as are a --check sample of them decoded. A tile failing to be
+    written is reported as such, not aborting the others. Return (tile, url, ok) list."""
+
+    def urls():
+        for tile in tiles:
+            if args.type == "XYZ":
+                url = args.url.format(x=tile.x, y=tile.y, z=tile.z)
+            elif args.type == "WMS":
+                xmin, ymin, xmax, ymax = xy_bounds(tile)
+                url = args.url.format(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
+            yield tile, url
+
+    target = {"jpg": "jpeg", "tif": "tiff"}.get(args.format.lower(), args.format.lower())
+
+    loop = asyncio.get_running_loop()
+    processes = futures.ProcessPoolExecutor(os.cpu_count())  # decoding, CPU bound
+    threads = futures.ThreadPoolExecutor(os.cpu_count())  # writing, I/O bound, but not to stall fetching
+
+    async def save(path, data, fmt):
+        """Write a tile, as downloaded or converted, off the event loop. Return True if ok."""
+
+        try:
+            if fmt != target:
+                return await loop.run_in_executor(processes, worker_convert, path, data)
+
+            await loop.run_in_executor(threads, write_bytes, path, data)
+            if random.random() < args.check:
+                return await loop.run_in_executor(processes, worker_check, path)
+            return True
+
+        except (OSError, cv2.error):
+            return False
+
+    results, pending = [], collections.deque()
+    with processes, threads:
+        fetched = fetch_all(urls(), args.rate, args.workers, args.timeout, args.host_workers, args.retries)
+        async for tile, url, data in fetched:
+            path = os.path.join(args.out, str(tile.z), str(tile.x), "{}.{}".format(tile.y, args.format))
+            fmt = image_format(data)
+
+            if fmt is None:  # nothing, or not an image (e.g an HTML error page)
+                results.append((tile, url, False))
+                progress.update()
+                continue
+
+            pending.append((tile, url, asyncio.ensure_future(save(path, data, fmt))))
+            while pending and (len(pending) > os.cpu_count() * 2 or pending[0][2].done()):
+                tile, url, task = pending.popleft()
+                results.append((tile, url, await task))
+                progress.update()
+
+        for tile, url, task in pending:
+            results.append((tile, url, await task))
+            progress.update()
+
+    return results
+
+
 def main(args):
 
     tiles = list(tiles_from_csv(args.cover))
     assert len(tiles), "Empty cover: {}".format(args.cover)
 
-    args.workers = min(os.cpu_count(), args.rate) if not args.workers else args.workers
+    args.workers = args.rate if not args.workers else args.workers  # requests are async, not bound to CPUs
 
     if os.path.dirname(os.path.expanduser(args.out)):
         os.makedirs(os.path.expanduser(args.out), exist_ok=True)
     log = Logs(os.path.join(args.out, "log"), out=sys.stderr)
     log.log("abd download with {} workers, at max {} req/s, from: {}".format(args.workers, args.rate, args.url))
 
-    already_dl = 0
-    dl = 0
+    def downloaded(tile):
+        return os.path.isfile(os.path.join(args.out, str(tile.z), str(tile.x), "{}.{}".format(tile.y, args.format)))
 
-    with requests.Session() as session:
-
-        progress = tqdm(total=len(tiles), ascii=True, unit="image")
-        with futures.ThreadPoolExecutor(args.workers) as executor:
-
-            def worker(tile):
-                tick = time.monotonic()
-                progress.update()
+    todo = [tile for tile in tiles if not downloaded(tile)]
+    already_dl = len(tiles) - len(todo)
+    dl = 0
 
-                try:
-                    x, y, z = map(str, [tile.x, tile.y, tile.z])
-                    os.makedirs(os.path.join(args.out, z, x), exist_ok=True)
-                except:
-                    return tile, None, False
-
-                path = os.path.join(args.out, z, x, "{}.{}".format(y, args.format))
-                if os.path.isfile(path):  # already downloaded
-                    return tile, None, True
-
-                if args.type == "XYZ":
-                    url = args.url.format(x=tile.x, y=tile.y, z=tile.z)
-                elif args.type == "WMS":
-                    xmin, ymin, xmax, ymax = xy_bounds(tile)
-                    url = args.url.format(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
-
-                res = tile_image_from_url(session, url, args.timeout)
-                if res is None:  # let's retry once
-                    res = tile_image_from_url(session, url, args.timeout)
-                    if res is None:
-                        return tile, url, False
-
-                try:
-                    tile_image_to_file(args.out, tile, res)
-                except OSError:
-                    return tile, url, False
-
-                tock = time.monotonic()
-
-                time_for_req = tock - tick
-                time_per_worker = args.workers / args.rate
-
-                if time_for_req < time_per_worker:
-                    time.sleep(time_per_worker - time_for_req)
-
-                return tile, url, True
-
-            for tile, url, ok in executor.map(worker, tiles):
-                if url and ok:
-                    dl += 1
-                elif not url and ok:
-                    already_dl += 1
-                else:
-                    log.log("Warning:\n {} failed, skipping.\n {}\n".format(tile, url))
+    progress = tqdm(total=len(todo), ascii=True, unit="image")
+    for tile, url, ok in asyncio.run(download(args, todo, progress)):
+        if ok:
+            dl += 1
+        else:
+            log.log("Warning:\n {} failed, skipping.\n {}\n".format(tile, url))
+    progress.close()
 
     if already_dl:
         log.log("Notice: {} tiles were already downloaded previously, and so skipped now.".format(already_dl))
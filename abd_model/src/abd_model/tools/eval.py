@@ -63,11 +63,11 @@ def main(args):
 
     assert torch.cuda.is_available(), "No GPU support found. Check CUDA and NVidia Driver install."
     assert torch.distributed.is_nccl_available(), "No NCCL support found. Check your PyTorch install."
-    world_size = 1  # Hard Coded since eval MultiGPUs not yet implemented
+    world_size = torch.cuda.device_count()
 
     args.workers = min(args.bs if not args.workers else args.workers, math.floor(os.cpu_count() / world_size))
 
-    print("abd eval on 1 GPU, with {} workers, and {} tiles/batch".format(args.workers, args.bs))
+    print("abd eval on {} GPUs, with {} workers/GPU, and {} tiles/batch/GPU".format(world_size, args.workers, args.bs))
 
     loader = load_module("abd_model.loaders.{}".format(config["model"]["loader"].lower()))
 
@@ -76,6 +76,7 @@ def main(args):
         config, config["model"]["ts"], args.dataset, args.cover, args.tiles_weights, "eval"
     )
     assert len(dataset), "Empty or Invalid --dataset content"
+    world_size = min(world_size, len(dataset))  # each rank with at least one tile
     shape_in = dataset.shape_in
     shape_out = dataset.shape_out
     print("DataSet Eval:            {}".format(args.dataset))
@@ -107,7 +108,8 @@ def gpu_worker(rank, world_size, lock_file, dataset, shape_in, shape_out, args,
     torch.cuda.set_device(rank)
     torch.manual_seed(0)
 
-    loader = DataLoader(dataset, batch_size=args.bs, shuffle=False, drop_last=True, num_workers=args.workers)
+    subset = torch.utils.data.Subset(dataset, range(rank, len(dataset), world_size))  # disjoint shards, no padding
+    loader = DataLoader(subset, batch_size=args.bs, shuffle=False, drop_last=False, num_workers=args.workers)
 
     nn_module = load_module("abd_model.nn.{}".format(config["model"]["nn"].lower()))
     nn = getattr(nn_module, config["model"]["nn"])(
@@ -128,7 +130,7 @@ def gpu_worker(rank, world_size, lock_file, dataset, shape_in, shape_out, args,
     nn.eval()
     with torch.no_grad():
         args.metrics = args.metrics if args.metrics else config["train"]["metrics"]
-        metrics = Metrics(args.metrics, config["classes"], config=config)
+        metrics = Metrics(args.metrics, config["classes"], device="cuda:{}".format(rank), config=config)
 
         assert len(loader), "Empty or Inconsistent DataSet"
         dataloader = tqdm(loader, desc="Eval", unit="Batch", ascii=True) if rank == 0 else loader
@@ -137,16 +139,15 @@ def gpu_worker(rank, world_size, lock_file, dataset, shape_in, shape_out, args,
             images = images.cuda(rank, non_blocking=True)
             masks = masks.cuda(rank, non_blocking=True)
             outputs = nn(images)
+            metrics.add(masks, outputs)
 
-            if rank == 0:
-                for mask, output in zip(masks, outputs):
-                    metrics.add(mask, output)
-
+        metrics.reduce()
         if rank == 0:
+            results = metrics.get()
             print("\n{}  μ\t   σ".format(" ".ljust(25, " ")))
             for c, classe in enumerate(config["classes"]):
                 if classe["weight"] != 0.0 and classe["color"] != "transparent":
-                    for k, v in metrics.get()[c].items():
+                    for k, v in results[c].items():
                         print("{}{:.3f}\t {:.3f}".format((classe["title"] + " " + k).ljust(25, " "), v["μ"], v["σ"]))
 
     dist.destroy_process_group()
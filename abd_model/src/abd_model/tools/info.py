@@ -33,7 +33,7 @@ def main(args):
 
         print(chkpt["doc_string"])
         for key in chkpt.keys():
-            if key in ["state_dict", "optimizer", "doc_string"]:
+            if key in ["state_dict", "optimizer", "scaler", "doc_string"]:
                 continue
             print(key.ljust(20) + ": " + str(chkpt[key]))
         sys.exit()
@@ -14,6 +14,8 @@ from torch.nn.parallel import DistributedDataParallel
 
 from abd_model.core import load_config, load_module, check_classes, check_channels, make_palette, web_ui, Logs
 from abd_model.tiles import tile_label_to_file, tiles_from_csv
+from abd_model.autotune import autotune_loader, loader_kwargs
+from abd_model.precision import autocast, check_precision
 
 
 def add_parser(subparser, formatter_class):
@@ -35,6 +37,9 @@ def add_parser(subparser, formatter_class):
     perf = parser.add_argument_group("Performances")
     perf.add_argument("--bs", type=int, help="batch size [default: CPU/GPU]")
     perf.add_argument("--workers", type=int, help="number of pre-processing images workers, per GPU [default: batch_size]")
+    perf.add_argument("--autotune", action="store_true", help="if set, autotune DataLoader workers and prefetch [cached]")
+    help = "inference precision [default: checkpoint training precision]"
+    perf.add_argument("--precision", type=str, choices=["fp32", "bf16", "fp16"], help=help)
 
     ui = parser.add_argument_group("Web UI")
     ui.add_argument("--web_ui_base_url", type=str, help="alternate Web UI base URL")
@@ -46,25 +51,30 @@ def add_parser(subparser, formatter_class):
 
 def gpu_worker(rank, world_size, lock_file, args, config, dataset, palette, transparency):
 
-    dist.init_process_group(backend="nccl", init_method="file://" + lock_file, world_size=world_size, rank=rank)
-    torch.cuda.set_device(rank)
-    chkpt = torch.load(args.checkpoint, map_location=torch.device(rank))
-    nn_module = load_module("abd_model.nn.{}".format(chkpt["nn"].lower()))
-    nn = getattr(nn_module, chkpt["nn"])(chkpt["shape_in"], chkpt["shape_out"], chkpt["encoder"].lower()).to(rank)
-    nn = DistributedDataParallel(nn, device_ids=[rank], find_unused_parameters=True)
+    backend = "nccl" if torch.cuda.is_available() else "gloo"
+    dist.init_process_group(backend=backend, init_method="file://" + lock_file, world_size=world_size, rank=rank)
+    device = torch.device("cuda", rank) if torch.cuda.is_available() else torch.device("cpu")
+    if device.type == "cuda":
+        torch.cuda.set_device(rank)
 
-    chkpt = torch.load(os.path.expanduser(args.checkpoint), map_location="cuda:{}".format(rank))
+    chkpt = torch.load(os.path.expanduser(args.checkpoint), map_location=device)
+    nn_module = load_module("abd_model.nn.{}".format(chkpt["nn"].lower()))
+    nn = getattr(nn_module, chkpt["nn"])(chkpt["shape_in"], chkpt["shape_out"], chkpt["encoder"].lower()).to(device)
+    nn = DistributedDataParallel(nn, device_ids=[rank] if device.type == "cuda" else None, find_unused_parameters=True)
     assert nn.module.version == chkpt["model_version"], "Model Version mismatch"
     nn.load_state_dict(chkpt["state_dict"])
 
     sampler = torch.utils.data.distributed.DistributedSampler(dataset, num_replicas=world_size, rank=rank)
-    loader = DataLoader(dataset, batch_size=args.bs, shuffle=False, num_workers=args.workers, sampler=sampler)
+    loader = DataLoader(dataset, batch_size=args.bs, shuffle=False, sampler=sampler, **args.loader_kwargs)
     assert len(loader), "Empty predict dataset directory. Check your path."
 
     C, W, H = chkpt["shape_out"]
 
+    def forward(images):
+        return nn(images.to(device)).data.float().cpu().numpy()  # float32 back, from autocast precision
+
     nn.eval()
-    with torch.no_grad():
+    with torch.no_grad(), autocast(device, args.precision):
 
         dataloader = tqdm(loader, desc="Predict", unit="Batch/GPU", ascii=True) if rank == 0 else loader
 
@@ -78,13 +88,13 @@ def gpu_worker(rank, world_size, lock_file, args, config, dataset, palette, tran
 
                 # fmt:off
                 probs = np.zeros((N, C, W, H), dtype=np.float)
-                probs[:, :, 0:hs, 0:hs] = nn(images[:, :, 0:ts, 0:ts].to(rank)).data.cpu().numpy()[:, :, qs:-qs, qs:-qs]
-                probs[:, :, 0:hs,  hs:] = nn(images[:, :, 0:ts,  hs:].to(rank)).data.cpu().numpy()[:, :, qs:-qs, qs:-qs]
-                probs[:, :, hs:,  0:hs] = nn(images[:, :, hs:,  0:ts].to(rank)).data.cpu().numpy()[:, :, qs:-qs, qs:-qs]
-                probs[:, :, hs:,   hs:] = nn(images[:, :, hs:,   hs:].to(rank)).data.cpu().numpy()[:, :, qs:-qs, qs:-qs]
+                probs[:, :, 0:hs, 0:hs] = forward(images[:, :, 0:ts, 0:ts])[:, :, qs:-qs, qs:-qs]
+                probs[:, :, 0:hs,  hs:] = forward(images[:, :, 0:ts,  hs:])[:, :, qs:-qs, qs:-qs]
+                probs[:, :, hs:,  0:hs] = forward(images[:, :, hs:,  0:ts])[:, :, qs:-qs, qs:-qs]
+                probs[:, :, hs:,   hs:] = forward(images[:, :, hs:,   hs:])[:, :, qs:-qs, qs:-qs]
                 # fmt:on
             else:
-                probs = nn(images.to(rank)).data.cpu().numpy()
+                probs = forward(images)
 
             for tile, prob in zip(tiles, probs):
                 x, y, z = list(map(int, tile))
@@ -101,10 +111,11 @@ def main(args):
     check_channels(config)
     check_classes(config)
 
-    assert torch.cuda.is_available(), "No GPU support found. Check CUDA and NVidia Driver install."
-    assert torch.distributed.is_nccl_available(), "No NCCL support found. Check your PyTorch install."
-
-    world_size = torch.cuda.device_count()
+    if torch.cuda.is_available():
+        assert torch.distributed.is_nccl_available(), "No NCCL support found. Check your PyTorch install."
+        world_size = torch.cuda.device_count()
+    else:
+        world_size = 1
     args.bs = args.bs if args.bs is not None else math.floor(os.cpu_count() / world_size)
     args.workers = args.workers if args.workers is not None else args.bs
 
@@ -115,7 +126,14 @@ def main(args):
     log = Logs(os.path.join(args.out, "log"))
 
     chkpt = torch.load(args.checkpoint, map_location=torch.device("cpu"))
-    log.log("abd predict on {} GPUs, with {} workers/GPU and {} tiles/batch".format(world_size, args.workers, args.bs))
+    args.precision = args.precision if args.precision else chkpt.get("precision", "fp32")
+    if args.precision == "fp16" and not torch.cuda.is_available():
+        args.precision = "bf16"  # fp16 trained model, predicted on CPU
+    check_precision(args.precision, "cuda" if torch.cuda.is_available() else "cpu")
+
+    device = "GPUs" if torch.cuda.is_available() else "CPU"
+    msg = "abd predict on {} {}, with {} workers/{} and {} tiles/batch, in {}"
+    log.log(msg.format(world_size, device, args.workers, device.rstrip("s"), args.bs, args.precision))
     log.log("Model {} - UUID: {}".format(chkpt["nn"], chkpt["uuid"]))
     log.log("---")
     loader = load_module("abd_model.loaders.{}".format(chkpt["loader"].lower()))
@@ -132,6 +150,11 @@ def main(args):
         keep_borders=args.keep_borders,
     )
 
+    if args.autotune:
+        args.loader_kwargs = autotune_loader(dataset, args.bs, math.floor(os.cpu_count() / world_size), log)
+    else:
+        args.loader_kwargs = loader_kwargs(args.workers, persistent_workers=False)
+
     mp.spawn(gpu_worker, nprocs=world_size, args=(world_size, lock_file, args, config, dataset, palette, transparency))
 
     if os.path.exists(lock_file):
@@ -1,7 +1,6 @@
 import os
 import re
 import sys
-import json
 import collections
 
 import numpy as np
@@ -9,11 +8,15 @@ from tqdm import tqdm
 from functools import partial
 import concurrent.futures as futures
 
+import shapely
+import mercantile
 import psycopg2
+import psycopg2.pool
 
-from abd_model.core import load_config, check_classes, make_palette, web_ui, Logs
+from abd_model.core import load_config, check_classes, make_palette, web_ui, Logs, ordered_map
 from abd_model.tiles import tiles_from_csv, tile_label_to_file, tile_bbox
-from abd_model.geojson import geojson_srid, geojson_tile_burn, geojson_parse_feature
+from abd_model.geojson import geojson_polygons, polygons_tiles, geometries_tile_burn, mercator
+from abd_model.vector import read_vector, vector_srid
 
 
 def add_parser(subparser, formatter_class):
@@ -25,7 +28,8 @@ def add_parser(subparser, formatter_class):
     inp.add_argument("--cover", type=str, required=True, help="path to csv tiles cover file [required]")
     inp.add_argument("--config", type=str, help="path to config file [required, if no global config setting]")
     inp.add_argument("--type", type=str, required=True, help="type of features to rasterize (i.e class title) [required]")
-    inp.add_argument("--geojson", type=str, nargs="+", help="path to GeoJSON features files")
+    help = "path to features files, format from extension (e.g .geojson .geojsonl .fgb .gpkg .parquet)"
+    inp.add_argument("--geojson", type=str, nargs="+", help=help)
     help = "SQL to retrieve geometry features [e.g SELECT geom FROM table WHERE ST_Intersects(TILE_GEOM, geom)]"
     inp.add_argument("--sql", type=str, help=help)
     inp.add_argument("--pg", type=str, help="If set, override config PostgreSQL dsn.")
@@ -38,6 +42,7 @@ def add_parser(subparser, formatter_class):
 
     perf = parser.add_argument_group("Performances")
     perf.add_argument("--workers", type=int, help="number of workers [default: CPU]")
+    perf.add_argument("--chunk", type=int, default=64, help="number of tiles burned at once, per worker [default: 64]")
 
     ui = parser.add_argument_group("Web UI")
     ui.add_argument("--web_ui_base_url", type=str, help="alternate Web UI base URL")
@@ -48,21 +53,127 @@ def add_parser(subparser, formatter_class):
 
 
 def worker_spatial_index(zoom, buffer, add_progress, geojson_path):
-    geojson = open(os.path.expanduser(geojson_path))
-    assert geojson, "Unable to open {}".format(geojson_path)
-    fc = json.load(geojson)
-    srid = geojson_srid(fc)
+    """Index a features file on tiles, batch by batch. Return its polygons, once each, as EPSG:3857 WKB array, and
+    for each tile, the indices of the polygons lying on it."""
 
-    feature_map = collections.defaultdict(list)
+    srid = vector_srid(geojson_path)
+
+    wkbs, tiles_indices, offset = [], collections.defaultdict(list), 0
     if add_progress:
-        progress = tqdm(total=len(fc["features"]), ascii=True, unit="feature")
-    for feature in fc["features"]:
-        feature_map = geojson_parse_feature(zoom, srid, feature_map, feature, buffer)
+        progress = tqdm(desc=os.path.basename(geojson_path), ascii=True, unit="feature")
+    for geometries, _ in read_vector(geojson_path):
+        polygons = [polygon for geometry in geometries for polygon in geojson_polygons(srid, geometry, buffer)]
+        polygons = np.array(polygons, dtype=object)
+        indices, xs, ys = polygons_tiles(polygons, zoom)  # a polygon is stored once, tiles only keep its index
+
+        order = np.lexsort((ys, xs))
+        indices, xs, ys = indices[order] + offset, xs[order], ys[order]
+        starts = np.flatnonzero(np.diff(xs, prepend=-1) | np.diff(ys, prepend=-1))
+        for i, tile_indices in zip(starts, np.split(indices, starts[1:])):
+            tiles_indices[mercantile.Tile(int(xs[i]), int(ys[i]), zoom)].append(tile_indices)
+
+        wkbs.append(shapely.to_wkb(shapely.transform(polygons, mercator)))
+        offset += len(polygons)
         if add_progress:
-            progress.update()
+            progress.update(len(geometries))
     if add_progress:
         progress.close()
-    return feature_map
+
+    wkbs = np.concatenate(wkbs) if wkbs else np.zeros(0, dtype=object)
+    return wkbs, {tile: np.concatenate(indices) for tile, indices in tiles_indices.items()}
+
+
+def worker_burn(out, palette, transparency, ts, burn_value, append, chunk):
+    """Burn and write a chunk of tiles, from their geometries indices in the chunk EPSG:3857 WKB array, decoded once
+    for all chunk tiles, or from their own EPSG:3857 WKB geometries. Return (tile, features number) list."""
+
+    tiles, wkbs = chunk
+    geometries = shapely.from_wkb(wkbs) if wkbs is not None else None
+
+    results = []
+    for tile, shapes in tiles:
+        shapes = geometries[shapes] if isinstance(shapes, np.ndarray) else shapely.from_wkb(shapes)
+        label = geometries_tile_burn(tile, shapes, ts, burn_value) if len(shapes) else None
+        num = len(shapes) if label is not None else 0
+        label = label if label is not None else np.zeros(shape=ts, dtype=np.uint8)
+
+        tile_label_to_file(out, tile, palette, transparency, label, append=append)
+        results.append((tile, num))
+
+    return results
+
+
+def sql_tiles_geometries(pool, sql, srid, tiles, log, itersize=10000):
+    """Yield (tile, EPSG:3857 WKB geometries), in tiles order, from a single query on the whole cover, streamed
+    through a server-side cursor. If the query fails, tiles left behind are then queried one by one."""
+
+    bounds = list(zip(*[tile_bbox(tile, mercator=True) for tile in tiles]))  # EPSG:3857 w, s, e, n arrays
+    query = """
+    WITH
+      abd_tiles AS (
+        SELECT i, ST_Transform(ST_MakeEnvelope(w, s, e, n, 3857), {}) AS geom
+        FROM unnest(%s::float8[], %s::float8[], %s::float8[], %s::float8[]) WITH ORDINALITY AS t(w, s, e, n, i)
+      )
+    SELECT abd_tiles.i, ST_AsBinary((ST_Dump(ST_Transform(ST_Force2D(abd_features."1"), 3857))).geom)
+    FROM abd_tiles CROSS JOIN LATERAL ({}) AS abd_features("1")
+    ORDER BY abd_tiles.i
+    """.format(
+        srid, sql.replace("%", "%%").replace("TILE_GEOM", "abd_tiles.geom")
+    )
+
+    done = 0  # tiles already yielded, rows being ordered by tile
+    geometries = []
+    conn = pool.getconn()
+    try:
+        with conn.cursor(name="abd_rasterize") as db:
+            db.itersize = itersize
+            db.execute(query, [list(values) for values in bounds])
+            for i, wkb in db:
+                while done < i - 1:
+                    yield tiles[done], geometries
+                    geometries, done = [], done + 1
+                geometries.append(bytes(wkb))
+
+        while done < len(tiles):
+            yield tiles[done], geometries
+            geometries, done = [], done + 1
+
+        pool.putconn(conn)
+        return
+
+    except psycopg2.Error as error:
+        log.log("Warning: single query failed, fallback to per tile queries: {}".format(str(error).strip()))
+        pool.putconn(conn, close=True)
+
+    conn = pool.getconn()
+    for tile in tiles[done:]:
+        w, s, e, n = tile_bbox(tile, mercator=True)
+        tile_geom = "ST_Transform(ST_MakeEnvelope({},{},{},{}, 3857), {})".format(w, s, e, n, srid)
+
+        query = """
+        WITH
+          sql  AS ({}),
+          geom AS (SELECT "1" AS geom FROM sql AS t("1"))
+        SELECT Array_Agg(ST_AsBinary((ST_Dump(ST_Transform(ST_Force2D(geom.geom), 3857))).geom))
+        FROM geom
+        """.format(
+            sql.replace("TILE_GEOM", tile_geom)
+        )
+
+        geometries = []
+        try:
+            with conn.cursor() as db:
+                db.execute(query)
+                row = db.fetchone()
+                geometries = [bytes(wkb) for wkb in row[0]] if row and row[0] else []
+        except psycopg2.Error:
+            log.log("Warning: Invalid geometries, skipping {}".format(tile))
+            pool.putconn(conn, close=True)  # broken transaction, or connection: replaced by a pool one
+            conn = pool.getconn()
+
+        yield tile, geometries
+
+    pool.putconn(conn)
 
 
 def main(args):
@@ -110,83 +221,83 @@ def main(args):
             progress = tqdm(total=len(args.geojson), ascii=True, unit="file")
             log_from = "{} geojson files".format(len(args.geojson))
 
+        wkbs, offset = [], 0
         feature_map = collections.defaultdict(list)
         with futures.ProcessPoolExecutor(workers) as executor:
-            for fm in executor.map(
+            for file_wkbs, fm in executor.map(
                 partial(worker_spatial_index, zoom, args.buffer, True if progress is None else False), args.geojson
             ):
-                for k, v in fm.items():
-                    try:
-                        feature_map[k] += v
-                    except KeyError:
-                        feature_map[k] = v
+                for tile, indices in fm.items():
+                    feature_map[tile].append(indices + offset)
+                wkbs.append(file_wkbs)
+                offset += len(file_wkbs)
                 if progress:
                     progress.update()
             if progress:
                 progress.close()
 
-    if args.sql:
-        conn = psycopg2.connect(args.pg)
-        db = conn.cursor()
+        feature_map = {tile: np.concatenate(indices) for tile, indices in feature_map.items()}
+        wkbs = np.concatenate(wkbs) if wkbs else np.zeros(0, dtype=object)
 
-        db.execute("""SELECT ST_Srid("1") AS srid FROM ({} LIMIT 1) AS t("1")""".format(sql))
-        srid = db.fetchone()[0]
+    if args.sql:
+        pool = psycopg2.pool.SimpleConnectionPool(1, 2, args.pg)
+        conn = pool.getconn()
+        with conn.cursor() as db:
+            db.execute("""SELECT ST_Srid("1") AS srid FROM ({} LIMIT 1) AS t("1")""".format(sql))
+            srid = db.fetchone()[0]
+        conn.rollback()
+        pool.putconn(conn)
         assert srid and int(srid) > 0, "Unable to retrieve geometry SRID."
 
         log_from = args.sql
 
-    if not len(feature_map):
+    if args.geojson and not len(feature_map):
         log.log("-----------------------------------------------")
         log.log("NOTICE: no feature to rasterize, seems peculiar")
         log.log("-----------------------------------------------")
 
-    log.log("abd rasterize - rasterizing {} from {} on cover {}".format(args.type, log_from, args.cover))
-    with open(os.path.join(os.path.expanduser(args.out), args.type.lower() + "_cover.csv"), mode="w") as cover:
+    def tiles_geometries():
+        if args.geojson:
+            for tile in tiles:
+                yield tile, feature_map[tile] if tile in feature_map else np.zeros(0, dtype=np.int64)
 
-        for tile in tqdm(tiles, ascii=True, unit="tile"):
+        if args.sql:
+            yield from sql_tiles_geometries(pool, args.sql, srid, tiles, log)
 
-            geojson = None
+    def chunk_geometries(chunk):  # only the chunk geometries are sent to a worker, once each, even if on several tiles
+        if not args.geojson:
+            return chunk, None
 
-            if args.sql:
-                w, s, e, n = tile_bbox(tile)
-                tile_geom = "ST_Transform(ST_MakeEnvelope({},{},{},{}, 4326), {})".format(w, s, e, n, srid)
+        indices = np.concatenate([shapes for tile, shapes in chunk])
+        unique = np.unique(indices)
+        return [(tile, np.searchsorted(unique, shapes)) for tile, shapes in chunk], wkbs[unique]
 
-                query = """
-                WITH
-                  sql  AS ({}),
-                  geom AS (SELECT "1" AS geom FROM sql AS t("1")),
-                  json AS (SELECT '{{"type": "Feature", "geometry": '
-                         || ST_AsGeoJSON((ST_Dump(ST_Transform(ST_Force2D(geom.geom), 4326))).geom, 6)
-                         || '}}' AS features
-                        FROM geom)
-                SELECT '{{"type": "FeatureCollection", "features": [' || Array_To_String(array_agg(features), ',') || ']}}'
-                FROM json
-                """.format(
-                    args.sql.replace("TILE_GEOM", tile_geom)
-                )
+    def chunks():
+        chunk = []
+        for item in tiles_geometries():
+            chunk.append(item)
+            if len(chunk) == args.chunk:
+                yield chunk_geometries(chunk)
+                chunk = []
+        if chunk:
+            yield chunk_geometries(chunk)
 
-                db.execute(query)
-                row = db.fetchone()
-                try:
-                    geojson = json.loads(row[0])["features"] if row and row[0] else None
-                except Exception:
-                    log.log("Warning: Invalid geometries, skipping {}".format(tile))
-                    conn = psycopg2.connect(args.pg)
-                    db = conn.cursor()
-
-            if args.geojson:
-                geojson = feature_map[tile] if tile in feature_map else None
-
-            if geojson:
-                num = len(geojson)
-                out = geojson_tile_burn(tile, geojson, 4326, list(map(int, args.ts.split(","))), burn_value)
-
-            if not geojson or out is None:
-                num = 0
-                out = np.zeros(shape=list(map(int, args.ts.split(","))), dtype=np.uint8)
-
-            tile_label_to_file(args.out, tile, palette, transparency, out, append=args.append)
-            cover.write("{},{},{}  {}{}".format(tile.x, tile.y, tile.z, num, os.linesep))
+    log.log("abd rasterize - rasterizing {} from {} on cover {}".format(args.type, log_from, args.cover))
+    ts = list(map(int, args.ts.split(",")))
+    with open(os.path.join(os.path.expanduser(args.out), args.type.lower() + "_cover.csv"), mode="w") as cover:
+        progress = tqdm(total=len(tiles), ascii=True, unit="tile")
+
+        with futures.ProcessPoolExecutor(args.workers) as executor:
+            worker = partial(worker_burn, args.out, palette, transparency, ts, burn_value, args.append)
+            for results in ordered_map(executor, worker, chunks(), window=args.workers * 2):  # cover order kept
+                for tile, num in results:
+                    cover.write("{},{},{}  {}{}".format(tile.x, tile.y, tile.z, num, os.linesep))
+                progress.update(len(results))
+
+        progress.close()
+
+    if args.sql:
+        pool.closeall()
 
     if not args.no_web_ui:
         template = "leaflet.html" if not args.web_ui_template else args.web_ui_template
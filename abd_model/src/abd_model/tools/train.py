@@ -1,5 +1,6 @@
 import os
 import math
+import argparse
 import uuid
 from tqdm import tqdm
 
@@ -8,14 +9,31 @@ import torch.optim
 import torch.backends.cudnn
 import torch.distributed as dist
 import torch.multiprocessing as mp
+import numpy as np
 
 from torch.utils.data import DataLoader
 from torch.nn.parallel import DistributedDataParallel
 
 import abd_model as abd
 from abd_model.core import load_config, load_module, check_model, check_channels, check_classes, Logs
+from abd_model.profiler import StepProfiler
+from abd_model.autotune import autotune_loader, loader_kwargs
+from abd_model.precision import autocast, grad_scaler, check_precision
+from abd_model.checkpoint import CheckpointWriter
 from abd_model.tiles import tiles_from_csv
-from abd_model.tools.dataset import compute_classes_weights
+from abd_model.metrics.core import StreamingMetrics
+from abd_model.tools.dataset import compute_classes_weights, load_histograms
+from abd_model.sampler import DistributedForegroundSampler
+
+
+def steps_window(value):
+    try:
+        first, last = map(int, value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expect first,last steps (e.g 10,20)")
+    if not 0 < first < last:
+        raise argparse.ArgumentTypeError("expect 0 < first < last steps (e.g 10,20)")
+    return first, last
 
 
 def add_parser(subparser, formatter_class):
@@ -28,6 +46,8 @@ def add_parser(subparser, formatter_class):
     data.add_argument("--classes_weights", type=str, help="classes weights separated with comma or 'auto' [optional]")
     data.add_argument("--tiles_weights", type=str, help="path to csv tiles cover file, to apply weights on [optional]")
     data.add_argument("--loader", type=str, help="dataset loader name [if set override config file value]")
+    help = "if set, max share of background only tiles, on each epoch samples [e.g 0.1]"
+    data.add_argument("--empty_ratio", type=float, help=help)
 
     hp = parser.add_argument_group("Hyper Parameters [if set override config file value]")
     hp.add_argument("--bs", type=int, help="batch size")
@@ -37,17 +57,37 @@ def add_parser(subparser, formatter_class):
     hp.add_argument("--encoder", type=str, help="encoder name")
     hp.add_argument("--optimizer", type=str, help="optimizer name")
     hp.add_argument("--loss", type=str, help="model loss")
+    help = "activation checkpointing: none, encoder, decoder, all, or blocks names (e.g layer1,layer2)"
+    hp.add_argument("--activation_checkpointing", type=str, help=help)
+    hp.add_argument("--precision", type=str, choices=["fp32", "bf16", "fp16"], help="training precision (bf16 on CPU)")
 
     mt = parser.add_argument_group("Training")
     mt.add_argument("--epochs", type=int, help="number of epochs to train")
     mt.add_argument("--resume", action="store_true", help="resume model training, if set imply to provide a checkpoint")
     mt.add_argument("--checkpoint", type=str, help="path to a model checkpoint. To fine tune or resume a training")
     mt.add_argument("--workers", type=int, help="number of pre-processing images workers, per GPU [default: batch size]")
+    mt.add_argument("--autotune", action="store_true", help="if set, autotune DataLoader workers and prefetch [cached]")
+
+    val = parser.add_argument_group("Validation")
+    val.add_argument("--val_cover", type=str, help="path to csv tiles cover file, to validate on, while training [optional]")
+    val.add_argument("--val_dataset", type=str, help="validation dataset path [default: --dataset]")
+    val.add_argument("--val_every", type=int, default=1, help="number of epochs beetwen validations [default: 1]")
+    val.add_argument("--metrics", type=str, nargs="+", help="validation metrics name (e.g QoD IoU MCC)")
 
     out = parser.add_argument_group("Output")
     out.add_argument("--saving", type=int, default=1, help="number of epochs beetwen checkpoint saving [default: 1]")
+    out.add_argument("--keep_last", type=int, help="if set, keep only the last N checkpoints saved [default: all]")
+    help = "if set, with --keep_last and --val_cover, keep also the best checkpoint, on validation loss"
+    out.add_argument("--keep_best", action="store_true", help=help)
+    help = "if set, save checkpoints without optimizer states, lighter to save and load, but not resumable"
+    out.add_argument("--weights_only", action="store_true", help=help)
     out.add_argument("--out", type=str, required=True, help="output directory path to save checkpoint and logs [required]")
 
+    prof = parser.add_argument_group("Profiling")
+    help = "if set, log steps timings summary per epoch, and save them in out/profile.json"
+    prof.add_argument("--profile", action="store_true", help=help)
+    prof.add_argument("--profile_trace", type=steps_window, help="torch profiler steps window to trace, on 1st epoch (e.g 10,20)")
+
     parser.set_defaults(func=main)
 
 
@@ -77,18 +117,25 @@ def main(args):
     config["train"]["loss"] = args.loss if args.loss else config["train"]["loss"]
     config["train"]["optimizer"]["name"] = args.optimizer if args.optimizer else config["train"]["optimizer"]["name"]
     config["train"]["optimizer"]["lr"] = args.lr if args.lr else config["train"]["optimizer"]["lr"]
+    config["train"]["precision"] = args.precision if args.precision else config["train"]["precision"]
+    if args.activation_checkpointing:
+        config["train"]["activation_checkpointing"] = args.activation_checkpointing
     check_classes(config)
     check_channels(config)
     check_model(config)
 
     log = Logs(os.path.join(args.out, "log"))
 
-    assert torch.cuda.is_available(), "No GPU support found. Check CUDA and NVidia Driver install."
-    assert torch.distributed.is_nccl_available(), "No NCCL support found. Check your PyTorch install."
-    world_size = torch.cuda.device_count()
+    if torch.cuda.is_available():
+        assert torch.distributed.is_nccl_available(), "No NCCL support found. Check your PyTorch install."
+        world_size = torch.cuda.device_count()
+    else:
+        world_size = 1  # CPU fallback, mostly relevant with bf16 precision
+    check_precision(config["train"]["precision"], "cuda" if torch.cuda.is_available() else "cpu")
 
     args.workers = min(config["train"]["bs"] if not args.workers else args.workers, math.floor(os.cpu_count() / world_size))
-    log.log("abd train on {} GPUs, with {} workers/GPU".format(world_size, args.workers))
+    device = "GPUs" if torch.cuda.is_available() else "CPU"
+    log.log("abd train on {} {}, with {} workers/{}".format(world_size, device, args.workers, device.rstrip("s")))
     log.log("---")
 
     loader = load_module("abd_model.loaders.{}".format(config["model"]["loader"].lower()))
@@ -102,9 +149,37 @@ def main(args):
     shape_out = dataset.shape_out
     log.log("\nDataSet:        {}".format(args.dataset))
 
+    val_dataset = None
+    if args.val_cover:
+        assert args.val_every > 0, "--val_every must be a positive epochs number"
+        args.val_dataset = args.val_dataset if args.val_dataset else args.dataset
+        assert os.path.isdir(os.path.expanduser(args.val_dataset)), "--val_dataset path is not a directory"
+        val_cover = [tile for tile in tiles_from_csv(os.path.expanduser(args.val_cover))]
+        val_dataset = getattr(loader, config["model"]["loader"])(
+            config, config["model"]["ts"], args.val_dataset, val_cover, None, "eval"
+        )
+        assert len(val_dataset), "Empty or Invalid --val_cover content"
+        log.log("Validation:     {} ({} tiles)".format(args.val_dataset, len(val_dataset)))
+    elif args.keep_best:  # a training loss is neither reduced across GPUs, nor comparable between epochs
+        log.log("Notice: --keep_best ignored, as implying a --val_cover to rank checkpoints on")
+        args.keep_best = False
+    args.metrics = args.metrics if args.metrics else config["train"]["metrics"]
+
+    if args.autotune:
+        max_workers = math.floor(os.cpu_count() / world_size)
+        args.loader_kwargs = autotune_loader(dataset, config["train"]["bs"], max_workers, log)
+    else:
+        args.loader_kwargs = loader_kwargs(args.workers)
+
     if args.classes_weights == "auto":
         args.classes_weights = compute_classes_weights(args.dataset, config["classes"], args.cover, os.cpu_count())
 
+    args.foreground = None
+    if args.empty_ratio is not None:
+        tiles, counts = load_histograms(args.dataset, len(config["classes"]), args.cover, os.cpu_count())
+        foreground = dict(zip(tiles, counts[:, 1:].sum(axis=1) / np.maximum(counts.sum(axis=1), 1)))
+        args.foreground = [foreground[tile] if tile in foreground else 0.0 for tile, path in dataset.tiles["labels"]]
+
     log.log("\n--- Input tensor")
     num_channel = 1  # 1-based numerotation
     for channel in config["channels"]:
@@ -122,30 +197,44 @@ def main(args):
 
     lock_file = os.path.abspath(os.path.join(args.out, str(uuid.uuid1())))
     mp.spawn(
-        gpu_worker, nprocs=world_size, args=(world_size, lock_file, dataset, shape_in, shape_out, args, config),
+        gpu_worker, nprocs=world_size, args=(world_size, lock_file, dataset, val_dataset, shape_in, shape_out, args, config),
     )
     if os.path.exists(lock_file):
         os.remove(lock_file)
 
 
-def gpu_worker(rank, world_size, lock_file, dataset, shape_in, shape_out, args, config):
+def gpu_worker(rank, world_size, lock_file, dataset, val_dataset, shape_in, shape_out, args, config):
 
     log = Logs(os.path.join(args.out, "log")) if rank == 0 else None
 
-    dist.init_process_group(backend="nccl", init_method="file://" + lock_file, world_size=world_size, rank=rank)
-    torch.cuda.set_device(rank)
+    backend = "nccl" if torch.cuda.is_available() else "gloo"
+    dist.init_process_group(backend=backend, init_method="file://" + lock_file, world_size=world_size, rank=rank)
+    device = torch.device("cuda", rank) if torch.cuda.is_available() else torch.device("cpu")
+    if device.type == "cuda":
+        torch.cuda.set_device(rank)
     torch.manual_seed(0)
 
     bs = config["train"]["bs"]
 
-    sampler = torch.utils.data.distributed.DistributedSampler(dataset, num_replicas=world_size, rank=rank)
-    loader = DataLoader(dataset, batch_size=bs, shuffle=False, drop_last=True, num_workers=args.workers, sampler=sampler)
+    if args.foreground is not None:
+        sampler = DistributedForegroundSampler(args.foreground, world_size, rank, args.empty_ratio)
+        if rank == 0:
+            msg = "\nEpoch size:\t {} tiles ({} with foreground, {} background only among {})"
+            log.log(msg.format(sampler.epoch_size, len(sampler.informative), sampler.num_empty, len(sampler.empty)))
+    else:
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset, num_replicas=world_size, rank=rank)
+    loader = DataLoader(dataset, batch_size=bs, shuffle=False, drop_last=True, sampler=sampler, **args.loader_kwargs)
+
+    val_loader = None
+    if val_dataset is not None:
+        val_subset = torch.utils.data.Subset(val_dataset, range(rank, len(val_dataset), world_size))  # no padding
+        val_loader = DataLoader(val_subset, batch_size=bs, shuffle=False, drop_last=False, **args.loader_kwargs)
 
     nn_module = load_module("abd_model.nn.{}".format(config["model"]["nn"].lower()))
     nn = getattr(nn_module, config["model"]["nn"])(
         shape_in, shape_out, config["model"]["encoder"].lower(), config["train"]
-    ).cuda(rank)
-    nn = DistributedDataParallel(nn, device_ids=[rank], find_unused_parameters=True)
+    ).to(device)
+    nn = DistributedDataParallel(nn, device_ids=[rank] if device.type == "cuda" else None, find_unused_parameters=True)
 
     optimizer_params = {key: value for key, value in config["train"]["optimizer"].items() if key != "name"}
     optimizer = getattr(torch.optim, config["train"]["optimizer"]["name"])(nn.parameters(), **optimizer_params)
@@ -167,9 +256,12 @@ def gpu_worker(rank, world_size, lock_file, dataset, shape_in, shape_out, args,
             if k != "params":
                 log.log(" - {}{}".format(k.ljust(25 - 3, " "), v))
 
+    precision = config["train"]["precision"]
+    scaler = grad_scaler(precision)
+
     resume = 0
     if args.checkpoint:
-        chkpt = torch.load(os.path.expanduser(args.checkpoint), map_location="cuda:{}".format(rank))
+        chkpt = torch.load(os.path.expanduser(args.checkpoint), map_location=device)
         assert nn.module.version == chkpt["model_version"], "Model Version mismatch"
         nn.load_state_dict(chkpt["state_dict"])
 
@@ -179,12 +271,20 @@ def gpu_worker(rank, world_size, lock_file, dataset, shape_in, shape_out, args,
             log.log("UUID:\t\t {}".format(chkpt["uuid"]))
 
         if args.resume:
+            assert "optimizer" in chkpt.keys() and chkpt["optimizer"], "Unable to resume from a weights only checkpoint"
             optimizer.load_state_dict(chkpt["optimizer"])
+            if "scaler" in chkpt.keys() and chkpt["scaler"]:
+                scaler.load_state_dict(chkpt["scaler"])
             resume = chkpt["epoch"]
             assert resume < args.epochs, "Epoch asked, already reached by the given checkpoint"
 
     loss_module = load_module("abd_model.losses.{}".format(config["train"]["loss"].lower()))
-    criterion = getattr(loss_module, config["train"]["loss"])().cuda(rank)
+    criterion = getattr(loss_module, config["train"]["loss"])().to(device)
+
+    writer = CheckpointWriter(args.out, args.keep_last, args.keep_best, args.weights_only, log) if rank == 0 else None
+
+    trace = args.profile_trace if rank == 0 else None
+    profiler = StepProfiler(device, enabled=args.profile and rank == 0, trace=trace, trace_dir=args.out)
 
     for epoch in range(resume + 1, args.epochs + 1):  # 1-N based
 
@@ -192,9 +292,20 @@ def gpu_worker(rank, world_size, lock_file, dataset, shape_in, shape_out, args,
             log.log("\n---\nEpoch: {}/{}\n".format(epoch, args.epochs))
 
         sampler.set_epoch(epoch)  # https://github.com/pytorch/pytorch/issues/31232
-        do_epoch(rank, loader, config, args.classes_weights, log, nn, criterion, epoch, optimizer)
+        do_epoch(rank, loader, config, args.classes_weights, log, nn, criterion, epoch, optimizer, profiler, scaler)
 
-        if rank == 0:
+        if rank == 0 and args.profile:  # training steps only, before validation
+            summary = profiler.summary()
+            profiler.log(log, summary)
+            profiler.dump(os.path.join(args.out, "profile.json"), epoch, summary)
+
+        loss = None  # only validated epochs, on loss reduced across ranks, are candidates to best checkpoint
+        if val_loader is not None:
+            if epoch == args.epochs or not (epoch % args.val_every):
+                metrics = StreamingMetrics(args.metrics, config["classes"], device, config)
+                loss = do_validation(rank, val_loader, config, args.classes_weights, log, nn, criterion, metrics)
+
+        if rank == 0 and (epoch == args.epochs or not (epoch % args.saving)):
             UUID = uuid.uuid1()
             states = {
                 "uuid": UUID,
@@ -211,43 +322,105 @@ def gpu_worker(rank, world_size, lock_file, dataset, shape_in, shape_out, args,
                 "nn": config["model"]["nn"],
                 "encoder": config["model"]["encoder"],
                 "optimizer": optimizer.state_dict(),
+                "scaler": scaler.state_dict(),
                 "loader": config["model"]["loader"],
+                "precision": precision,
             }
             checkpoint_path = os.path.join(args.out, "checkpoint-{:05d}.pth".format(epoch))
-            if epoch == args.epochs or not (epoch % args.saving):
-                log.log("\n--- Saving Checkpoint ---")
-                log.log("Path:\t\t {}".format(checkpoint_path))
-                log.log("UUID:\t\t {}\n".format(UUID))
-                torch.save(states, checkpoint_path)
+            log.log("\n--- Saving Checkpoint ---")
+            log.log("Path:\t\t {}".format(checkpoint_path))
+            log.log("UUID:\t\t {}\n".format(UUID))
+            writer.save(states, epoch, loss)  # CPU snapshot, written in background
 
         dist.barrier()
 
+    if rank == 0:
+        writer.close()
+
     dist.destroy_process_group()
 
 
-def do_epoch(rank, loader, config, classes_weights, log, nn, criterion, epoch, optimizer=None):
+def do_epoch(rank, loader, config, classes_weights, log, nn, criterion, epoch, optimizer=None, profiler=None, scaler=None):
     num_samples = 0
     running_loss = 0.0
+    device = next(nn.parameters()).device
+    precision = config["train"]["precision"]
+    scaler = scaler if scaler else grad_scaler(precision)
 
     assert len(loader), "Empty or Inconsistent DataSet"
     dataloader = tqdm(loader, desc="Train", unit="Batch/GPU", ascii=True) if rank == 0 else loader
 
+    profiler = profiler if profiler else StepProfiler(device, enabled=False)
+    profiler.reset()
+
     for images, masks, tiles, tiles_weights in dataloader:
-        images = images.cuda(rank, non_blocking=True)
-        masks = masks.cuda(rank, non_blocking=True)
+        profiler.lap("data")
+
+        images = images.to(device, non_blocking=True)
+        masks = masks.to(device, non_blocking=True)
+        profiler.lap("h2d")
 
         num_samples += int(images.size(0))
 
         # Forward
-        outputs = nn(images)
-        loss = criterion(outputs, masks, classes_weights, tiles_weights, config)
+        with autocast(device, precision):
+            outputs = nn(images)
+        loss = criterion(outputs.float(), masks, classes_weights, tiles_weights, config)  # loss stay in float32
         running_loss += loss.item()
+        profiler.lap("forward")
 
         # Backward
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        profiler.lap("backward")
 
+        scaler.step(optimizer)
+        scaler.update()
+        profiler.lap("optimizer")
+
+        profiler.step(int(images.size(0)), epoch)
+
+    profiler.trace_stop(epoch)  # if the epoch ended before the trace window
     assert num_samples > 0, "DataSet inconsistencies"
     if rank == 0:
         log.log("{}{:.3f}".format("Loss:".ljust(25, " "), running_loss / num_samples))
+
+    return running_loss / num_samples
+
+
+def do_validation(rank, loader, config, classes_weights, log, nn, criterion, metrics):
+    """Evaluate the live model, with dataset wide metrics, reduced across ranks. Return validation loss."""
+
+    device = next(nn.parameters()).device
+    precision = config["train"]["precision"]
+    running = torch.zeros(2, dtype=torch.float64, device=device)  # loss sum, samples
+
+    nn.eval()
+    with torch.no_grad():
+        dataloader = tqdm(loader, desc="Validation", unit="Batch/GPU", ascii=True) if rank == 0 else loader
+        for images, masks, tiles, tiles_weights in dataloader:
+            images = images.to(device, non_blocking=True)
+            masks = masks.to(device, non_blocking=True)
+
+            with autocast(device, precision):
+                outputs = nn(images)
+            outputs = outputs.float()
+
+            running[0] += criterion(outputs, masks, classes_weights, tiles_weights, config) * images.size(0)
+            running[1] += images.size(0)
+            metrics.add(masks, outputs)
+    nn.train()
+
+    running = metrics.reduce(running)  # counts and loss, in a single all-reduce
+    assert running[1] > 0, "Empty or Inconsistent validation DataSet"
+    loss = float(running[0] / running[1])
+
+    if rank == 0:
+        log.log("{}{:.3f}".format("Validation Loss:".ljust(25, " "), loss))
+        results = metrics.get()
+        for c, classe in enumerate(config["classes"]):
+            if classe["weight"] != 0.0 and classe["color"] != "transparent":
+                for k, v in results[c].items():
+                    log.log("{}{:.3f}".format(("Validation " + classe["title"] + " " + k + ":").ljust(25, " "), v))
+
+    return loss
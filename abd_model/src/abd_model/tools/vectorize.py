@@ -2,62 +2,192 @@ import os
 import sys
 from tqdm import tqdm
 
+import cv2
 import numpy as np
 from PIL import Image
 
-import json
-import mercantile
+import shapely
+import shapely.geometry
+from functools import partial
+import concurrent.futures as futures
 import rasterio.features
 import rasterio.transform
 
-from abd_model.core import load_config, check_classes
+from abd_model.core import load_config, check_classes, ordered_map
 from abd_model.tiles import tiles_from_dir
+from abd_model.vector import VectorWriter
 
 
 def add_parser(subparser, formatter_class):
-    parser = subparser.add_parser("vectorize", help="Extract GeoJSON from tiles masks", formatter_class=formatter_class)
+    help = "Extract vector features from tiles masks"
+    parser = subparser.add_parser("vectorize", help=help, formatter_class=formatter_class)
 
     inp = parser.add_argument_group("Inputs")
     inp.add_argument("--masks", type=str, required=True, help="input masks directory path [required]")
     inp.add_argument("--type", type=str, required=True, help="type of features to extract (i.e class title) [required]")
     inp.add_argument("--config", type=str, help="path to config file [required, if no global config setting]")
 
+    perf = parser.add_argument_group("Performances")
+    perf.add_argument("--workers", type=int, help="number of workers [default: CPU]")
+    perf.add_argument("--chunk", type=int, default=64, help="number of masks processed at once, per worker [default: 64]")
+
     out = parser.add_argument_group("Outputs")
-    out.add_argument("--out", type=str, required=True, help="path to output file to store features in [required]")
+    help = "path to output features file, format from extension (e.g .geojson .fgb .gpkg .parquet) [required]"
+    out.add_argument("--out", type=str, required=True, help=help)
+    help = "if set, don't merge features straddling tiles borders, in a single one"
+    out.add_argument("--no_stitch", action="store_true", help=help)
 
     parser.set_defaults(func=main)
 
 
+class UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        self.parent.setdefault(item, item)
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]  # path halving
+            item = self.parent[item]
+        return item
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+
+def pixels_to_lonlat(geometry, z, W, H):
+    """Project a geometry from global pixels coordinates, at zoom z and W,H tiles size, to EPSG:4326."""
+
+    def project(coords):
+        lon = coords[:, 0] / (W * 2 ** z) * 360.0 - 180.0
+        lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * coords[:, 1] / (H * 2 ** z)))))
+        return np.stack([lon, lat], axis=1)
+
+    return shapely.transform(geometry, project)
+
+
+def worker_vectorize(index, stitch, chunk):
+    """Polygonize a chunk of masks. Return, in masks order, features geometries, and if stitch, the components
+    touching a tile border, left apart in global pixels coordinates, with their tile edges labels."""
+
+    features = []
+    borders = []
+    for tile, path in chunk:
+        mask = (np.array(Image.open(path).convert("P"), dtype=np.uint8) == index).astype(np.uint8)
+        H, W = mask.shape[-2:]
+
+        _, labels = cv2.connectedComponents(mask, connectivity=4)  # as rasterio.features.shapes
+        transform = rasterio.transform.Affine(1, 0, tile.x * W, 0, 1, tile.y * H)  # exact, even across tiles
+
+        edges = {"top": labels[0], "bottom": labels[-1], "left": labels[:, 0], "right": labels[:, -1]}
+        border = set(np.unique(np.concatenate(list(edges.values())))) - {0} if stitch else set()
+
+        components = []
+        for shape, label in rasterio.features.shapes(labels, mask=mask.astype(bool), transform=transform):
+            geometry = shapely.geometry.shape(shape)
+            if int(label) in border:
+                components.append((int(label), geometry))
+            else:
+                features.append(pixels_to_lonlat(geometry, tile.z, W, H))
+
+        if components:
+            borders.append((tile, W, H, components, edges))
+
+    return features, borders
+
+
+class Stitcher:
+    def __init__(self):
+        """Merge components touching each others across tiles edges, with an union-find, incrementally. Tiles are
+        to be added in rows order, so groups out of reach of next tiles are flushed, and only the last tiles row edges
+        kept: memory is bounded by the coverage width, rather than by the number of tiles."""
+
+        self.groups = UnionFind()
+        self.members = {}  # group root: [z, last row, W, H, geometries, members]
+        self.edges = {}  # tile: (right, bottom) edges labels, to be matched by next tiles
+        self.row = None
+
+    def union(self, a, b):
+        a, b = self.groups.find(a), self.groups.find(b)
+        if a == b:
+            return
+
+        self.groups.union(a, b)
+        root, other = (a, b) if self.groups.find(a) == a else (b, a)
+        other = self.members.pop(other)
+        self.members[root][1] = max(self.members[root][1], other[1])
+        self.members[root][4].extend(other[4])
+        self.members[root][5].extend(other[5])
+
+    def add(self, tile, W, H, components, edges):
+        """Add a tile border components, with its edges labels. Yield merged geometries out of reach of next tiles."""
+
+        if (tile.z, tile.y) != self.row:  # previous rows are complete, and only the last one could be reached still
+            self.row = (tile.z, tile.y)
+            yield from self.flush(lambda z, row: z != tile.z or row < tile.y - 1)
+            self.edges = {t: e for t, e in self.edges.items() if t.z == tile.z and t.y == tile.y - 1}
+
+        for label, geometry in components:
+            self.members[(tile, label)] = [tile.z, tile.y, W, H, [geometry], [(tile, label)]]
+
+        left, top = type(tile)(tile.x - 1, tile.y, tile.z), type(tile)(tile.x, tile.y - 1, tile.z)
+        for side, neighbour, neighbour_side in [("left", left, 0), ("top", top, 1)]:
+            if neighbour not in self.edges or len(self.edges[neighbour][neighbour_side]) != len(edges[side]):
+                continue
+
+            a, b = edges[side], self.edges[neighbour][neighbour_side]
+            both = (a > 0) & (b > 0)
+            for label, neighbour_label in set(zip(a[both].tolist(), b[both].tolist())):
+                self.union((tile, label), (neighbour, neighbour_label))
+
+        self.edges[tile] = (edges["right"], edges["bottom"])
+
+    def flush(self, done=lambda z, row: True):
+        """Yield merged geometries of the groups done, and forget them."""
+
+        for root, (z, row, W, H, geometries, members) in list(self.members.items()):
+            if not done(z, row):
+                continue
+
+            del self.members[root]
+            for member in members:
+                self.groups.parent.pop(member, None)
+
+            geometry = geometries[0] if len(geometries) == 1 else shapely.unary_union(geometries)
+            for polygon in getattr(geometry, "geoms", [geometry]):
+                yield pixels_to_lonlat(polygon, z, W, H)
+
+
 def main(args):
     config = load_config(args.config)
     check_classes(config)
     index = [i for i in (list(range(len(config["classes"])))) if config["classes"][i]["title"] == args.type]
     assert index, "Requested type {} not found among classes title in the config file.".format(args.type)
 
-    masks = list(tiles_from_dir(args.masks, xyz_path=True))
+    masks = sorted(tiles_from_dir(args.masks, xyz_path=True), key=lambda mask: (mask[0].z, mask[0].y, mask[0].x))
     assert len(masks), "empty masks directory: {}".format(args.masks)
 
-    print("abd vectorize {} from {}".format(args.type, args.masks), file=sys.stderr, flush=True)
+    if not args.workers:
+        args.workers = os.cpu_count()
 
-    if os.path.dirname(os.path.expanduser(args.out)):
-        os.makedirs(os.path.dirname(os.path.expanduser(args.out)), exist_ok=True)
-    out = open(args.out, "w", encoding="utf-8")
-    assert out, "Unable to write in output file"
+    msg = "abd vectorize {} from {}, with {} workers".format(args.type, args.masks, args.workers)
+    print(msg, file=sys.stderr, flush=True)
 
-    out.write('{"type":"FeatureCollection","features":[')
+    out = VectorWriter(args.out)
 
-    first = True
-    for tile, path in tqdm(masks, ascii=True, unit="mask"):
-        mask = (np.array(Image.open(path).convert("P"), dtype=np.uint8) == index).astype(np.uint8)
-        try:
-            C, W, H = mask.shape
-        except:
-            W, H = mask.shape
-        transform = rasterio.transform.from_bounds((*mercantile.bounds(tile.x, tile.y, tile.z)), W, H)
-
-        for shape, value in rasterio.features.shapes(mask, transform=transform, mask=mask):
-            geom = '"geometry":{{"type": "Polygon", "coordinates":{}}}'.format(json.dumps(shape["coordinates"]))
-            out.write('{}{{"type":"Feature",{}}}'.format("" if first else ",", geom))
-            first = False
-
-    out.write("]}")
+    chunks = [masks[i : i + args.chunk] for i in range(0, len(masks), args.chunk)]
+    progress = tqdm(total=len(masks), ascii=True, unit="mask")
+
+    stitcher = Stitcher()  # features touching a tile border are kept in memory, until stitched
+    with futures.ProcessPoolExecutor(args.workers) as executor:
+        worker = partial(worker_vectorize, index[0], not args.no_stitch)
+        for chunk, (features, borders) in zip(chunks, ordered_map(executor, worker, chunks, window=args.workers * 2)):
+            out.write_batch(features + [geometry for border in borders for geometry in stitcher.add(*border)])
+            progress.update(len(chunk))
+    progress.close()
+
+    out.write_batch(list(stitcher.flush()))
+
+    out.close()
@@ -0,0 +1,405 @@
+"""Streaming vector features I/O, with format chosen by file extension.
+
+GeoJSON and GeoJSONSeq are written as plain text. FlatGeobuf (with spatial index) and GeoPackage are written
+through GDAL (pyogrio), GeoParquet through pyarrow, both as Arrow batches of WKB geometries. Geometries are in
+EPSG:4326 (i.e OGC:CRS84 lon/lat axis order).
+"""
+
+import os
+import re
+import json
+import queue
+import threading
+
+import numpy as np
+import shapely
+import shapely.geometry
+
+from abd_model.geojson import geojson_srid
+
+formats = {
+    ".geojson": "GeoJSON",
+    ".json": "GeoJSON",
+    ".geojsonl": "GeoJSONSeq",
+    ".geojsons": "GeoJSONSeq",
+    ".geojsonseq": "GeoJSONSeq",
+    ".fgb": "FlatGeobuf",
+    ".gpkg": "GPKG",
+    ".parquet": "GeoParquet",
+    ".geoparquet": "GeoParquet",
+}
+
+
+def vector_format(path):
+    """Vector format, from a file path extension."""
+
+    extension = os.path.splitext(path)[1].lower()
+    assert extension in formats, "Unsupported vector format {}, expected: {}".format(extension, ", ".join(formats))
+    return formats[extension]
+
+
+def to_geometries(geometries):
+    """Shapely geometries array, from shapely geometries or GeoJSON like geometries dicts. Invalid ones are None."""
+
+    def shape(geometry):
+        try:
+            return shapely.geometry.shape(geometry) if isinstance(geometry, dict) else geometry
+        except:  # e.g a ring with less than 4 coordinates: skipped, rather than aborting the whole file
+            return None
+
+    return np.array([shape(geometry) for geometry in geometries], dtype=object)
+
+
+def geojson_members(fp, chunk_size=2 ** 20, features=True):
+    """Incrementally parse a GeoJSON FeatureCollection file. Yield its top level members, as (name, value), except
+    features, yielded one by one, as ("feature", feature), or if not features, skipped without being decoded.
+    Memory is bounded by the largest feature, not by the file."""
+
+    decoder = json.JSONDecoder()
+    strings = re.compile(r'"(?:[^"\\]|\\.)*"')
+    brackets = np.zeros(256, dtype=np.int8)
+    brackets[[ord("["), ord("{")]], brackets[[ord("]"), ord("}")]] = 1, -1
+    buffer, position, eof = "", 0, False
+
+    def read(size):
+        nonlocal buffer, position, eof
+        data = fp.read(size)
+        eof = not data
+        buffer, position = buffer[position:] + data, 0
+
+    def skip(chars=""):  # skip whitespaces and chars, return next char, or "" at end of file
+        nonlocal position
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or buffer[position] in chars):
+                position += 1
+            if position < len(buffer) or eof:
+                return buffer[position] if position < len(buffer) else ""
+            read(chunk_size)
+
+    def decode():
+        nonlocal position
+        skip()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+                if end < len(buffer) or eof:  # a value ending with the buffer could be truncated
+                    position = end
+                    return value
+            except json.JSONDecodeError:
+                assert not eof, "Invalid or truncated GeoJSON"
+            read(max(chunk_size, len(buffer) - position))  # grows geometrically, for large features
+
+    def skip_value():  # skip an array or object, vectorized: brackets depths cumulated, out of strings
+        nonlocal position
+        depth = 0
+        while True:
+            segment = buffer[position:]
+            if "\\" in segment:  # escaped quotes: strings blanked first, up to a string truncated by the buffer end
+                segment = strings.sub(lambda match: " " * len(match.group()), segment)
+                segment = segment[: segment.find('"')] if '"' in segment else segment
+
+            data = np.frombuffer(segment.encode("utf-8"), dtype=np.uint8)
+            quotes = np.flatnonzero(data == ord('"'))
+            indices = np.flatnonzero(brackets[data])
+            indices = indices[(np.searchsorted(quotes, indices) & 1) == 0]  # out of strings
+            depths = depth + np.cumsum(brackets[data[indices]], dtype=np.int64)
+
+            end = np.flatnonzero(depths == 0)
+            if len(end):
+                position += int(np.count_nonzero((data[: indices[end[0]] + 1] & 0xC0) != 0x80))  # UTF-8 bytes, to chars
+                return
+
+            cut = int(quotes[-1]) if len(quotes) & 1 else len(data)  # a string truncated by the buffer end, read again
+            depth = int(depths[np.searchsorted(indices, cut) - 1]) if np.searchsorted(indices, cut) else depth
+            position += int(np.count_nonzero((data[:cut] & 0xC0) != 0x80))
+            assert not eof, "Invalid or truncated GeoJSON"
+            read(chunk_size)
+
+    def expect(char):
+        nonlocal position
+        assert skip() == char, "Invalid GeoJSON, {} expected".format(char)
+        position += 1
+
+    expect("{")
+    while skip(",") not in ["}", ""]:
+        name = decode()
+        expect(":")
+        if name != "features":
+            yield name, decode()
+            continue
+
+        if not features:
+            assert skip() == "[", "Invalid GeoJSON, [ expected"
+            skip_value()
+            continue
+
+        expect("[")
+        while skip(",") != "]":
+            assert skip(), "Invalid or truncated GeoJSON"
+            yield "feature", decode()
+        expect("]")
+
+
+class VectorWriter:
+    def __init__(self, path, properties=None, batch_size=65536):
+        """Streaming vector features writer. Properties schema as {name: type}, with type among int, float, str."""
+
+        self.path = os.path.expanduser(path)
+        self.format = vector_format(self.path)
+        self.properties = properties if properties else {}
+        self.batch_size = batch_size
+        self.count = 0
+
+        self.geometries = []
+        self.columns = {name: [] for name in self.properties}
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        if self.format in ["GeoJSON", "GeoJSONSeq"]:
+            self.fp = open(self.path, "w", encoding="utf-8")
+            if self.format == "GeoJSON":
+                self.fp.write('{"type":"FeatureCollection","features":[')
+            return
+
+        import pyarrow as pa
+
+        types = {"int": pa.int64(), "float": pa.float64(), "str": pa.string()}
+        fields = [pa.field(name, types[kind]) for name, kind in self.properties.items()]
+        self.schema = pa.schema([pa.field("geometry", pa.binary())] + fields)
+
+        if self.format == "GeoParquet":
+            import pyarrow.parquet as pq
+
+            bbox = pa.struct([(k, pa.float64()) for k in ["xmin", "ymin", "xmax", "ymax"]])
+            self.schema = self.schema.append(pa.field("bbox", bbox))
+            covering = {"bbox": {k: ["bbox", k] for k in ["xmin", "ymin", "xmax", "ymax"]}}
+            geo = {
+                "version": "1.1.0",
+                "primary_column": "geometry",
+                "columns": {"geometry": {"encoding": "WKB", "geometry_types": [], "covering": covering}},
+            }
+            self.schema = self.schema.with_metadata({"geo": json.dumps(geo)})
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression="zstd")
+            return
+
+        # GDAL pulls batches from a RecordBatchReader, so it runs in its own thread, fed by a bounded queue
+        self.queue = queue.Queue(maxsize=2)
+        self.error = None
+        self.thread = threading.Thread(target=self.ogr_worker, daemon=True)
+        self.thread.start()
+
+    def ogr_worker(self):
+        import pyarrow as pa
+        import pyogrio
+
+        def batches():
+            while True:
+                batch = self.queue.get()
+                if batch is None:
+                    return
+                yield batch
+
+        try:
+            reader = pa.RecordBatchReader.from_batches(self.schema, batches())
+            options = {"SPATIAL_INDEX": "YES"} if self.format == "FlatGeobuf" else {}
+            pyogrio.write_arrow(
+                reader, self.path, driver=self.format, geometry_name="geometry", geometry_type="Unknown",
+                crs="EPSG:4326", layer_options=options,
+            )
+        except Exception as error:
+            self.error = error
+            while self.queue.get() is not None:  # unlock producer
+                pass
+
+    def write(self, geometry, properties=None):
+        """Append a feature, geometry as shapely geometry or GeoJSON like dict."""
+
+        self.write_batch([geometry], {k: [v] for k, v in properties.items()} if properties else None)
+
+    def write_batch(self, geometries, columns=None):
+        """Append features, from geometries and properties columns (i.e {name: values})."""
+
+        if self.format in ["GeoJSON", "GeoJSONSeq"]:
+            serialized = shapely.to_geojson(to_geometries(geometries))
+            for i, geometry in enumerate(serialized):
+                properties = json.dumps({k: v[i] for k, v in columns.items()}) if columns else "{}"
+                geometry = geometry if geometry is not None else "null"
+                feature = '{{"type":"Feature","geometry":{},"properties":{}}}'.format(geometry, properties)
+                if self.format == "GeoJSON":
+                    self.fp.write(feature if not self.count else "," + feature)
+                else:
+                    self.fp.write(feature + "\n")
+                self.count += 1
+            return
+
+        self.geometries.extend(geometries)
+        for name in self.columns:
+            self.columns[name].extend(columns[name] if columns and name in columns else [None] * len(geometries))
+
+        if len(self.geometries) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.geometries:
+            return
+
+        import pyarrow as pa
+
+        geometries = to_geometries(self.geometries)
+        arrays = [pa.array(shapely.to_wkb(geometries), pa.binary())]
+        arrays += [pa.array(self.columns[name], self.schema.field(name).type) for name in self.columns]
+        if self.format == "GeoParquet":
+            bounds = shapely.bounds(geometries)
+            arrays.append(pa.StructArray.from_arrays(list(bounds.T), ["xmin", "ymin", "xmax", "ymax"]))
+
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        self.count += len(geometries)
+        self.geometries = []
+        self.columns = {name: [] for name in self.columns}
+
+        if self.format == "GeoParquet":
+            self.writer.write_batch(batch)
+        else:
+            assert self.error is None, "Unable to write {}: {}".format(self.path, self.error)
+            self.queue.put(batch)
+
+    def close(self):
+        if self.format in ["GeoJSON", "GeoJSONSeq"]:
+            if self.format == "GeoJSON":
+                self.fp.write("]}")
+            self.fp.close()
+            return
+
+        self.flush()
+        if self.format == "GeoParquet":
+            self.writer.close()
+        else:
+            self.queue.put(None)
+            self.thread.join()
+            assert self.error is None, "Unable to write {}: {}".format(self.path, self.error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_vector(path, bbox=None, batch_size=65536):
+    """Yield features batches, as (shapely geometries array, {name: values} properties columns).
+
+    bbox: if set, as (xmin, ymin, xmax, ymax), only features intersecting it are read. Spatial index (FlatGeobuf,
+    GeoPackage) or bbox covering column (GeoParquet) are used to skip others, without decoding them.
+    """
+
+    path = os.path.expanduser(path)
+    fmt = vector_format(path)
+
+    for geometries, columns in read_batches(path, fmt, bbox, batch_size):
+        if bbox is not None:
+            keep = shapely.intersects(geometries, shapely.box(*bbox))
+            geometries = geometries[keep]
+            columns = {name: [v for v, k in zip(values, keep) if k] for name, values in columns.items()}
+
+        if len(geometries):
+            yield geometries, columns
+
+
+def read_batches(path, fmt, bbox, batch_size):
+
+    if fmt == "GeoJSON":
+        with open(path, encoding="utf-8") as fp:
+            features = []
+            for name, value in geojson_members(fp):
+                if name == "feature":
+                    features.append(value)
+                if len(features) == batch_size:
+                    yield features_to_batch(features)
+                    features = []
+            if features:
+                yield features_to_batch(features)
+
+    if fmt == "GeoJSONSeq":
+        with open(path, encoding="utf-8") as fp:
+            features = []
+            for line in fp:
+                line = line.strip().lstrip("\x1e")  # RFC 8142 record separator
+                if line:
+                    features.append(json.loads(line))
+                if len(features) == batch_size:
+                    yield features_to_batch(features)
+                    features = []
+            if features:
+                yield features_to_batch(features)
+
+    if fmt in ["FlatGeobuf", "GPKG"]:
+        import pyogrio.raw
+
+        with pyogrio.raw.open_arrow(path, bbox=bbox, batch_size=batch_size, use_pyarrow=True) as (meta, reader):
+            geometry_name = meta["geometry_name"] or "wkb_geometry"
+            for batch in reader:
+                columns = {name: batch.column(name).to_pylist() for name in batch.schema.names if name != geometry_name}
+                yield shapely.from_wkb(batch.column(geometry_name).to_numpy(zero_copy_only=False)), columns
+
+    if fmt == "GeoParquet":
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        geo = json.loads((pq.read_schema(path).metadata or {}).get(b"geo", b"{}"))
+        geometry_name = geo.get("primary_column", "geometry")
+        covering = geo.get("columns", {}).get(geometry_name, {}).get("covering", {}).get("bbox")
+
+        expression = None
+        if bbox is not None and covering:
+            field = lambda key: ds.field(*covering[key])  # noqa: E731
+            xmin, ymin, xmax, ymax = bbox
+            expression = (field("xmin") <= xmax) & (field("xmax") >= xmin)
+            expression = expression & (field("ymin") <= ymax) & (field("ymax") >= ymin)
+
+        skip = [geometry_name, covering["xmin"][0] if covering else None]
+        for batch in ds.dataset(path, format="parquet").to_batches(filter=expression, batch_size=batch_size):
+            columns = {name: batch.column(name).to_pylist() for name in batch.schema.names if name not in skip}
+            yield shapely.from_wkb(batch.column(geometry_name).to_numpy(zero_copy_only=False)), columns
+
+
+def vector_srid(path):
+    """Features SRID, from GeoJSON crs member, GeoParquet or GDAL metadata. Default: 4326."""
+
+    path = os.path.expanduser(path)
+    fmt = vector_format(path)
+    srid = None
+
+    if fmt == "GeoJSON":
+        with open(path, encoding="utf-8") as fp:
+            for name, value in geojson_members(fp, features=False):  # crs member could be set after features
+                if name == "crs":
+                    srid = geojson_srid({"crs": value})
+                    break
+
+    if fmt in ["FlatGeobuf", "GPKG"]:
+        import pyogrio
+
+        crs = pyogrio.read_info(path)["crs"]
+        srid = crs.split(":")[-1] if crs and crs.upper().startswith("EPSG:") else None
+
+    if fmt == "GeoParquet":
+        import pyarrow.parquet as pq
+
+        geo = json.loads((pq.read_schema(path).metadata or {}).get(b"geo", b"{}"))
+        crs = geo.get("columns", {}).get(geo.get("primary_column", "geometry"), {}).get("crs")
+        crs_id = crs.get("id", {}) if isinstance(crs, dict) else {}  # PROJJSON, none meaning OGC:CRS84
+        srid = crs_id.get("code") if crs_id.get("authority") == "EPSG" else None
+
+    try:
+        return int(srid)
+    except:
+        return 4326
+
+
+def features_to_batch(features):
+    geometries = to_geometries([feature.get("geometry") for feature in features])
+    names = sorted(set([name for feature in features for name in (feature.get("properties") or {})]))
+    columns = {name: [(feature.get("properties") or {}).get(name) for feature in features] for name in names}
+
+    return geometries, columns
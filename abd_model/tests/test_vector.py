@@ -0,0 +1,57 @@
+"""
+Tests of the vector features reading, as used by cover and rasterize --geojson.
+
+Run with: pytest abd_model/tests
+"""
+import json
+
+import pytest
+import shapely
+
+from abd_model.geojson import geojson_polygons
+from abd_model.vector import read_vector, to_geometries
+
+VALID = {"type": "Polygon", "coordinates": [[[0.1, 0.1], [0.11, 0.1], [0.11, 0.11], [0.1, 0.1]]]}
+INVALID = {"type": "Polygon", "coordinates": [[[0, 0], [0.01, 0]]]}  # ring with less than 4 coordinates, even closed
+
+
+def feature(geometry, id):
+    return {"type": "Feature", "properties": {"id": id}, "geometry": geometry}
+
+
+def test_to_geometries_invalid():
+    geometries = to_geometries([INVALID, VALID, None, shapely.Point(0, 0)])
+
+    assert geometries[0] is None
+    assert geometries[1].equals(shapely.geometry.shape(VALID))
+    assert geometries[2] is None
+    assert geometries[3].equals(shapely.Point(0, 0))
+
+
+@pytest.mark.parametrize("extension", [".geojson", ".geojsonl"])
+def test_read_vector_invalid_polygon(tmp_path, extension):
+    features = [feature(INVALID, 1), feature(VALID, 2)]
+    path = tmp_path / ("features" + extension)
+    if extension == ".geojson":
+        path.write_text(json.dumps({"type": "FeatureCollection", "features": features}))
+    else:
+        path.write_text("\n".join(json.dumps(f) for f in features))
+
+    batches = list(read_vector(str(path)))
+    assert len(batches) == 1
+
+    geometries, columns = batches[0]
+    assert columns == {"id": [1, 2]}
+    assert geometries[0] is None
+
+    polygons = [polygon for geometry in geometries for polygon in geojson_polygons(4326, geometry)]
+    assert len(polygons) == 1 and polygons[0].equals(shapely.geometry.shape(VALID))
+
+
+def test_read_vector_invalid_polygon_bbox(tmp_path):
+    path = tmp_path / "features.geojson"
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": [feature(INVALID, 1), feature(VALID, 2)]}))
+
+    (geometries, columns), = read_vector(str(path), bbox=(0, 0, 1, 1))
+    assert columns == {"id": [2]}
+    assert len(geometries) == 1
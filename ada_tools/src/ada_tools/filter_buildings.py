@@ -3,8 +3,8 @@ import pandas as pd
 import click
 from tqdm import tqdm
 import os
-import shutil
 import time
+from ada_tools.vector_io import read_vector, write_vector
 start_time = time.time()
 
 SPLIT_SIZE = 1000
@@ -127,29 +127,30 @@ def merge_touching_buildings(gdf):
 
 
 @click.command()
-@click.option('--data', help='input (vector format)')
-@click.option('--dest', help='output (vector format)')
+@click.option('--data', help='input (vector format, from extension)')
+@click.option('--dest', help='output (vector format, from extension: .geojson, .fgb, .gpkg, .parquet)')
 @click.option('--crsmeters', default='EPSG:4087', help='CRS in unit meters, to filter small buildings [default: EPSG:4087]')
 @click.option('--waterbodies', default='', help='vector file of water bodies, to filter artifacts')
 @click.option('--area', default=10, help='minimum building area, in m2 [default: 10]')
-def main(data, dest, crsmeters, waterbodies, area):
+@click.option('--merge/--no-merge', default=True, help='merge touching buildings, useless on abd vectorize stitched output [default: merge]')
+def main(data, dest, crsmeters, waterbodies, area, merge):
     """ merge touching buildings, filter small ones, simplify geometry """
 
-    gdf = gpd.read_file(data)
+    gdf = read_vector(data)
     crs_original = gdf.crs
 
     if len(gdf) == 0:
-        shutil.copyfile(data, dest)
+        write_vector(gpd.GeoDataFrame(geometry=[], crs="EPSG:4326"), dest)
         return
 
-    print(f'merge ({len(gdf)} entries)')
-
     # merge touching buildings
-    gdf_list_split = divide_by_num_disj([gdf])
-    if len(gdf_list_split) > 1:
-        gdf_list_merged = merge_each_gdf_in_list(gdf_list_split)
-        gdf = combine_and_merge(gdf_list_merged)
-        print(f"merge completed ({len(gdf)} buildings)")
+    if merge:
+        print(f'merge ({len(gdf)} entries)')
+        gdf_list_split = divide_by_num_disj([gdf])
+        if len(gdf_list_split) > 1:
+            gdf_list_merged = merge_each_gdf_in_list(gdf_list_split)
+            gdf = combine_and_merge(gdf_list_merged)
+            print(f"merge completed ({len(gdf)} buildings)")
 
     # filter small stuff
     print(f"second filter ({len(gdf)} entries)")
@@ -168,7 +169,7 @@ def main(data, dest, crsmeters, waterbodies, area):
     # filter by water bodies
     if len(gdf) > 0 and os.path.exists(waterbodies):
         print('filtering by water bodies')
-        gdf_water = gpd.read_file(waterbodies)
+        gdf_water = read_vector(waterbodies)
         if gdf.crs != gdf_water.crs:
             gdf = gdf.to_crs(gdf_water.crs)
         gdf = gpd.sjoin(gdf, gdf_water, how='left', predicate='intersects')
@@ -176,14 +177,13 @@ def main(data, dest, crsmeters, waterbodies, area):
         gdf = gdf[['geometry']]
 
     if len(gdf) == 0:
-        with open(dest, "w") as text_file:
-            text_file.write('{"type": "FeatureCollection", "features": []}')
+        write_vector(gpd.GeoDataFrame(geometry=[], crs="EPSG:4326"), dest)
         return
 
     # project to WGS84 and save
     if gdf.crs != "EPSG:4326":
         gdf = gdf.to_crs("EPSG:4326")
-    gdf.to_file(dest, driver='GeoJSON')
+    write_vector(gdf, dest)
 
     print("--- %s seconds ---" % (time.time() - start_time))
 
@@ -1,17 +1,17 @@
-import geopandas as gpd
 import pandas as pd
 import click
 from tqdm import tqdm
 import numpy as np
+from ada_tools.vector_io import read_vector, write_vector
 
 
 @click.command()
 @click.option('--builds', help='input (buildings)')
 @click.option('--damage', help='input (damage classes)')
-@click.option('--out', default='buildings_predictions.geojson', help='input')
+@click.option('--out', default='buildings_predictions.geojson', help='output (vector format, from extension)')
 @click.option('--thresh', default="no", help='threshold to binarize output')
 def main(builds, damage, out, thresh):
-    df = gpd.read_file(builds).to_crs(epsg="4326")
+    df = read_vector(builds).to_crs(epsg="4326")
     df = df.loc[~df["geometry"].is_empty]
     if "OBJECTID" in df.columns:
         df.index = df["OBJECTID"]
@@ -33,7 +33,7 @@ def main(builds, damage, out, thresh):
         except:
             df.at[index, 'damage'] = np.nan
         df.at[index, 'ID'] = index
-    df.to_file(out, driver='GeoJSON')
+    write_vector(df, out)
 
 
 if __name__ == "__main__":
@@ -1,19 +1,25 @@
+import hashlib
+import http.client
+import json
 import os
 import os.path
+import random
+import re
 import sys
 import threading
 import time
+import urllib.error
 import urllib.request
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from typing import Dict, List, Tuple
+from typing import Callable, List, Optional, Set, Tuple
 
 import click
 from bs4 import BeautifulSoup
 from tqdm import tqdm
 
-# Global mapping of thread ids to tqdm progress bars to show download progress.
-PROGRESS_BARS: Dict[int, tqdm] = {}
+# Size of the blocks read from responses, and written to disk.
+BLOCK_SIZE = 2 ** 20
 
 
 def get_maxar_image_urls(disaster: str) -> List[str]:
@@ -49,36 +55,292 @@ def split_pre_post(images: List[str], splitdate) -> Tuple[List[str], List[str]]:
     return images_pre, images_post
 
 
+class Bandwidth:
+    """
+    Token bucket shared by all download threads, to limit the aggregate bandwidth to
+    `rate` bytes per second. No limit if rate is None.
+    """
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = rate
+        self.tokens = rate or 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, size: int) -> None:
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        time.sleep(wait)
+
+
+class Download:
+    """
+    Resumable download of an url to path, split in ranges of `chunk_size` bytes that
+    can be fetched in parallel.
+
+    Data is written into `path.part`, preallocated to the remote size, and completed
+    ranges are recorded in `path.part.json`, along with the remote size and ETag, so an
+    interrupted download resumes where it stopped, unless the remote file changed.
+    The file is only moved to path once complete and verified.
+    """
+
+    def __init__(self, url: str, path: str, chunk_size: int):
+        self.url = url
+        self.path = path
+        self.part = path + ".part"
+        self.state = path + ".part.json"
+        self.chunk_size = chunk_size
+        self.size: Optional[int] = None
+        self.etag: Optional[str] = None
+        self.ranges: List[Tuple[int, int]] = []
+        self.done: Set[int] = set()
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def prepare(self, timeout: float) -> None:
+        """
+        Get the remote size and ETag, then either resume from a matching previous
+        state, or start over. Ranges are only used if the server accepts them.
+        """
+        request = urllib.request.Request(self.url, method="HEAD")
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            length = response.headers.get("Content-Length")
+            self.size = int(length) if length is not None else None
+            self.etag = response.headers.get("ETag")
+            ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+
+        if self.complete():
+            return
+
+        if self.size and ranges:
+            self.ranges = [
+                (start, min(start + self.chunk_size, self.size) - 1)
+                for start in range(0, self.size, self.chunk_size)
+            ]
+        else:  # a single request, without resume
+            self.ranges = [(0, self.size - 1 if self.size is not None else None)]
+
+        try:
+            with open(self.state) as fp:
+                state = json.load(fp)
+            resume = (
+                ranges
+                and state["url"] == self.url
+                and state["size"] == self.size
+                and state["etag"] == self.etag
+                and state["chunk_size"] == self.chunk_size
+                and os.path.getsize(self.part) == self.size
+            )
+        except (OSError, ValueError, KeyError):
+            resume = False
+
+        if resume:
+            self.done = set(state["done"])
+        else:
+            with open(self.part, "wb") as fp:
+                if self.size is not None:
+                    fp.truncate(self.size)
+            self.save()
+
+    def complete(self) -> bool:
+        "Whether path already exists, with the remote size."
+        return os.path.isfile(self.path) and os.path.getsize(self.path) == self.size
+
+    def pending(self) -> List[int]:
+        return [i for i in range(len(self.ranges)) if i not in self.done]
+
+    def remaining(self) -> int:
+        "Remaining bytes to download, if the size is known."
+        return sum(self.ranges[i][1] - self.ranges[i][0] + 1 for i in self.pending()) if self.size else 0
+
+    def save(self) -> None:
+        state = {
+            "url": self.url,
+            "size": self.size,
+            "etag": self.etag,
+            "chunk_size": self.chunk_size,
+            "done": sorted(self.done),
+        }
+        with open(self.state + ".tmp", "w") as fp:
+            json.dump(state, fp)
+        os.replace(self.state + ".tmp", self.state)
+
+    def fetch(
+        self,
+        index: int,
+        bandwidth: Bandwidth,
+        progress: Callable[[int], None],
+        timeout: float,
+        retries: int,
+    ) -> None:
+        """
+        Download the range `index` into the .part file. Network errors, 429 and 5xx
+        responses are retried with exponential backoff; bytes already reported to
+        progress by a failed attempt are taken back.
+        """
+        start, end = self.ranges[index]
+        headers = {}
+        if len(self.ranges) > 1:
+            headers["Range"] = f"bytes={start}-{end}"
+            if self.etag:  # the server answers 412 if the file changed meanwhile
+                headers["If-Match"] = self.etag
+
+        for attempt in range(retries + 1):
+            if self.failed:
+                return
+            written = 0
+            try:
+                request = urllib.request.Request(self.url, headers=headers)
+                with urllib.request.urlopen(request, timeout=timeout) as response, open(self.part, "r+b") as fp:
+                    if "Range" in headers and response.status != 206:
+                        self.failed = True
+                        raise ValueError(f"{self.url}: range not served")
+                    fp.seek(start)
+                    while True:
+                        block = response.read(BLOCK_SIZE)
+                        if not block or self.failed:
+                            break
+                        bandwidth.consume(len(block))
+                        fp.write(block)
+                        written += len(block)
+                        progress(len(block))
+                    if end is None:
+                        fp.truncate()
+                if self.failed:
+                    progress(-written)
+                    return
+                if end is not None and written != end - start + 1:
+                    raise http.client.IncompleteRead(b"", end - start + 1 - written)
+                break
+            except (OSError, http.client.HTTPException) as e:
+                progress(-written)
+                retry = not isinstance(e, urllib.error.HTTPError) or e.code == 429 or e.code >= 500
+                if not retry or attempt == retries:
+                    self.failed = True
+                    raise
+                time.sleep(random.uniform(0, 2 ** attempt))
+
+        with self.lock:
+            self.done.add(index)
+            self.save()
+            if len(self.done) < len(self.ranges):
+                return
+        self.finalize()
+
+    def finalize(self) -> None:
+        """
+        Verify the size, and the MD5 if the ETag is one (i.e. not multipart uploaded),
+        then atomically move the .part file to path.
+        """
+        size = os.path.getsize(self.part)
+        assert self.size is None or size == self.size, f"{self.url}: {size} bytes instead of {self.size}"
+
+        etag = (self.etag or "").strip('"')
+        if re.fullmatch(r"[0-9a-f]{32}", etag):
+            md5 = hashlib.md5()
+            with open(self.part, "rb") as fp:
+                for block in iter(lambda: fp.read(BLOCK_SIZE), b""):
+                    md5.update(block)
+            if md5.hexdigest() != etag:
+                os.remove(self.state)  # corrupted, start over next time
+                raise ValueError(f"{self.url}: MD5 {md5.hexdigest()} does not match ETag {etag}")
+
+        os.replace(self.part, self.path)
+        os.remove(self.state)
+
+
 def download_images(
     images: List[Tuple[str, str]],
     max_threads: int = None,
-    progress_format: float = 1e6
-) -> None:
+    progress_format: float = 1e6,
+    chunk_size: int = 64 * 2 ** 20,
+    max_bandwidth: Optional[float] = None,
+    retries: int = 5,
+    timeout: float = 60,
+) -> List[str]:
     """
     list: List of tuples of the form (url, destination path).
     max_threads: Maximum number of concurrent threads to download from. If None,
         Python's heuristics are used.
     progress_format: Download progress is printed as bytes / `progress_format`. For
         example, a value of 1e3 would print as kilobytes, 1e6 as megabytes, and so on.
+    chunk_size: Files are downloaded in ranges of `chunk_size` bytes, fetched in
+        parallel and resumable from a previous interrupted run.
+    max_bandwidth: Maximum aggregate download rate, in bytes per second. If None,
+        no limit.
+    retries: Number of retries for each range, on network or server errors.
+    timeout: Seconds without any data received before a request is retried.
+
+    Images whose destination path already exists, with the remote size, are skipped.
+    Return the urls that failed to download; their partial data is kept, to be resumed.
     """
-    # reporthook function to update the progress bars
-    def _reporthook(count, block_size, total_size):
-        pbar = PROGRESS_BARS[threading.get_ident()]
-        pbar.total = total_size / progress_format
-        pbar.update(block_size / progress_format)
+    bandwidth = Bandwidth(max_bandwidth)
+    failed = []
 
-    # wrapper function to pass to the threads
-    def _download(url_tuple):
-        url, path = url_tuple
-        # create the progress bar
-        ident = threading.get_ident()
-        PROGRESS_BARS[ident] = tqdm(desc=f"Thread {ident}")
+    with ThreadPoolExecutor(max_workers=max_threads) as executor:
 
-        urllib.request.urlretrieve(url, path, _reporthook)
+        def _prepare(download):
+            try:
+                download.prepare(timeout)
+                return download
+            except (OSError, http.client.HTTPException) as e:
+                print(f"{download.url}: {e}", file=sys.stderr)
+                failed.append(download.url)
 
-    with ThreadPoolExecutor(max_workers=max_threads) as executor:
-        executor.map(_download, images)
+        # HEAD requests first, to know the total size, what is already downloaded, and what to skip
+        downloads = []
+        for download in executor.map(_prepare, [Download(url, path, chunk_size) for url, path in images]):
+            if download is not None and not download.complete():
+                downloads.append(download)
 
+        total = sum(download.size or 0 for download in downloads)
+        remaining = sum(download.remaining() for download in downloads)
+        pbar = tqdm(
+            total=total,
+            initial=total - remaining,
+            unit_scale=1 / progress_format,
+            bar_format="{l_bar}{bar}| {n:.1f}/{total:.1f} [{elapsed}<{remaining}]",
+        )
+        pbar_lock = threading.Lock()
+
+        def _progress(size):
+            with pbar_lock:
+                pbar.update(size)
+
+        futures = {
+            executor.submit(download.fetch, index, bandwidth, _progress, timeout, retries): download
+            for download in downloads
+            for index in download.pending()
+        }
+        # all ranges downloaded, but interrupted before being verified and moved in place
+        futures.update(
+            {executor.submit(download.finalize): download for download in downloads if not download.pending()}
+        )
+        try:
+            for future in as_completed(futures):
+                download = futures[future]
+                try:
+                    future.result()
+                except (OSError, ValueError, http.client.HTTPException) as e:
+                    if download.url not in failed:
+                        print(f"{download.url}: {e}", file=sys.stderr)
+                        failed.append(download.url)
+        except KeyboardInterrupt:  # stop running ranges, the completed ones are kept to resume
+            for future in futures:
+                future.cancel()
+            for download in downloads:
+                download.failed = True
+            raise
+        finally:
+            pbar.close()
+
+    return failed
 
 
 @click.command()
@@ -99,7 +361,20 @@ def download_images(
     default="MB",
     help="size unit to format the download progress bar"
 )
-def main(disaster, dest, splitdate, maxpre, maxpost, maxthreads, progress_format):
+@click.option(
+    '--chunksize',
+    default=64,
+    type=int,
+    help="size in MB of the ranges files are split into, downloaded in parallel and resumable"
+)
+@click.option(
+    '--maxbandwidth',
+    default=None,
+    type=float,
+    help="max aggregate download rate in MB/s, if omitted no limit"
+)
+@click.option('--retries', default=5, help='number of retries of each range, on network or server errors')
+def main(disaster, dest, splitdate, maxpre, maxpost, maxthreads, progress_format, chunksize, maxbandwidth, retries):
     os.makedirs(dest, exist_ok=True)
     os.makedirs(dest+'/pre-event', exist_ok=True)
     os.makedirs(dest+'/post-event', exist_ok=True)
@@ -130,11 +405,18 @@ def main(disaster, dest, splitdate, maxpre, maxpost, maxthreads, progress_format
         [(url, os.path.join(dest, "post-event", url.replace("https://maxar-opendata.s3.us-west-2.amazonaws.com/events/", "").replace("/", "-"))) for url in images_post]
     )
 
-    download_images(
+    failed = download_images(
         images=paths,
         max_threads=maxthreads,
         progress_format=size_numerator,
+        chunk_size=chunksize * 2 ** 20,
+        max_bandwidth=maxbandwidth * 1e6 if maxbandwidth else None,
+        retries=retries,
     )
+    if failed:
+        print("Failed to download, run load-images again to resume:")
+        print("\n".join(failed))
+        sys.exit(1)
 
 
 if __name__ == "__main__":
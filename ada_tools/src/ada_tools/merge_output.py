@@ -1,22 +1,24 @@
 import geopandas as gpd
+import pandas as pd
 import os
 import click
+from ada_tools.vector_io import read_vector, write_vector
 
 
 @click.command()
 @click.option('--dir', help='directory with results')
 @click.option('--path', default='', help='string in path')
 @click.option('--data', default='buildings-predictions.geojson', help='result filename')
-@click.option('--dest', default='buildings-predictions.geojson', help='output')
+@click.option('--dest', default='buildings-predictions.geojson', help='output (vector format, from extension)')
 def main(dir, path, data, dest):
-    gdf_merged = gpd.GeoDataFrame()
+    gdfs = []
     for root, dirs, files in os.walk(dir):
         for file in files:
             if data in file and path in root:
                 print(f'merging {os.path.join(root, file)}')
-                gdf = gpd.read_file(os.path.join(root, file))
-                gdf_merged = gdf_merged.append(gdf, ignore_index=True)
-    gdf_merged.to_file(dest, driver="GeoJSON")
+                gdfs.append(read_vector(os.path.join(root, file)))
+    gdf_merged = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True)) if gdfs else gpd.GeoDataFrame()
+    write_vector(gdf_merged, dest)
 
 
 if __name__ == "__main__":
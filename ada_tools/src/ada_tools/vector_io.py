@@ -0,0 +1,31 @@
+import os
+import geopandas as gpd
+
+DRIVERS = {
+    ".geojson": "GeoJSON",
+    ".json": "GeoJSON",
+    ".geojsonl": "GeoJSONSeq",
+    ".geojsons": "GeoJSONSeq",
+    ".fgb": "FlatGeobuf",
+    ".gpkg": "GPKG",
+    ".shp": "ESRI Shapefile",
+}
+PARQUET = [".parquet", ".geoparquet"]
+
+
+def read_vector(path, bbox=None):
+    """ read a vector file, format from extension; if bbox (xmin, ymin, xmax, ymax) is set, only intersecting features """
+    if os.path.splitext(path)[1].lower() in PARQUET:
+        return gpd.read_parquet(path, bbox=bbox)
+    return gpd.read_file(path, bbox=bbox)
+
+
+def write_vector(gdf, path):
+    """ write a vector file, format from extension (GeoJSON if unknown); FlatGeobuf with a spatial index """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in PARQUET:
+        gdf.to_parquet(path, write_covering_bbox=True)
+    elif extension == ".fgb":
+        gdf.to_file(path, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+    else:
+        gdf.to_file(path, driver=DRIVERS.get(extension, "GeoJSON"))
@@ -0,0 +1,205 @@
+"""
+Tests of the load-images download engine, against a local HTTP server serving files
+with HEAD, Range requests and MD5 ETags, as Maxar S3 bucket does.
+
+Run with: pytest ada_tools/tests
+"""
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ada_tools.get_images_maxar import Bandwidth, Download, download_images
+
+CHUNK_SIZE = 64 * 1024
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return None, None
+
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        start, end, status = 0, len(data) - 1, 200
+        if self.command == "GET" and "Range" in self.headers:
+            if self.headers.get("If-Match", etag) != etag:
+                self.send_error(412)
+                return None, None
+            start, end = map(int, self.headers["Range"].split("=")[1].split("-"))
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return data, (start, end)
+
+    def do_HEAD(self):
+        self.send_head()
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.gets.append(self.path)
+            fail = self.server.failures > 0
+            self.server.failures -= 1
+
+        if fail:  # every other failure a 503, or a connection dropped midway
+            if self.server.failures % 2:
+                self.send_error(503)
+                return
+            data, (start, end) = self.send_head()
+            self.wfile.write(data[start : start + (end - start) // 2])
+            self.close_connection = True
+            return
+
+        data, span = self.send_head()
+        if data is not None:
+            self.wfile.write(data[span[0] : span[1] + 1])
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.daemon_threads = True
+    server.files = {
+        "/big.tif": os.urandom(10 * CHUNK_SIZE + 123),
+        "/small.tif": os.urandom(1000),
+    }
+    server.gets = []
+    server.failures = 0
+    server.lock = threading.Lock()
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def images(server, tmp_path, names=("big.tif", "small.tif")):
+    return [(f"{server.url}/{name}", str(tmp_path / name)) for name in names]
+
+
+def downloaded(server, tmp_path, name):
+    path = tmp_path / name
+    return path.read_bytes() == server.files["/" + name] and not os.path.exists(f"{path}.part")
+
+
+def test_download_in_ranges(server, tmp_path):
+    failed = download_images(images(server, tmp_path), max_threads=4, chunk_size=CHUNK_SIZE)
+
+    assert failed == []
+    assert downloaded(server, tmp_path, "big.tif")
+    assert downloaded(server, tmp_path, "small.tif")
+    assert server.gets.count("/big.tif") == 11
+    assert sorted(os.listdir(tmp_path)) == ["big.tif", "small.tif"]  # no state left
+
+
+def test_skip_complete_files(server, tmp_path):
+    download_images(images(server, tmp_path), chunk_size=CHUNK_SIZE)
+    server.gets.clear()
+
+    assert download_images(images(server, tmp_path), chunk_size=CHUNK_SIZE) == []
+    assert server.gets == []
+
+
+def test_incomplete_file_downloaded_again(server, tmp_path):
+    (tmp_path / "big.tif").write_bytes(server.files["/big.tif"][:1000])  # as left by an interrupted urlretrieve
+
+    assert download_images(images(server, tmp_path, ["big.tif"]), chunk_size=CHUNK_SIZE) == []
+    assert downloaded(server, tmp_path, "big.tif")
+
+
+def test_resume_from_part(server, tmp_path):
+    url, path = images(server, tmp_path, ["big.tif"])[0]
+    download = Download(url, path, CHUNK_SIZE)
+    download.prepare(timeout=10)
+    for index in [0, 3, 4]:
+        download.fetch(index, bandwidth=Bandwidth(), progress=lambda size: None, timeout=10, retries=0)
+    server.gets.clear()
+
+    assert download_images([(url, path)], chunk_size=CHUNK_SIZE) == []
+    assert downloaded(server, tmp_path, "big.tif")
+    assert len(server.gets) == 8  # only the missing ranges
+
+
+def test_finalize_after_last_range(server, tmp_path):
+    """Interrupted once all ranges saved, but before being verified and moved in place."""
+    url, path = images(server, tmp_path, ["big.tif"])[0]
+    download = Download(url, path, CHUNK_SIZE)
+    download.prepare(timeout=10)
+    with open(download.part, "wb") as fp:
+        fp.write(server.files["/big.tif"])
+    download.done = set(range(len(download.ranges)))
+    download.save()
+    server.gets.clear()
+
+    assert download_images([(url, path)], chunk_size=CHUNK_SIZE) == []
+    assert downloaded(server, tmp_path, "big.tif")
+    assert not os.path.exists(download.state)
+    assert server.gets == []
+
+
+def test_corrupted_part_downloaded_again(server, tmp_path):
+    url, path = images(server, tmp_path, ["big.tif"])[0]
+    download = Download(url, path, CHUNK_SIZE)
+    download.prepare(timeout=10)
+    with open(download.part, "wb") as fp:
+        fp.write(b"x" * len(server.files["/big.tif"]))
+    download.done = set(range(len(download.ranges)))
+    download.save()
+
+    assert download_images([(url, path)], chunk_size=CHUNK_SIZE) == [url]  # MD5 mismatch
+    assert not os.path.exists(path)
+
+    assert download_images([(url, path)], chunk_size=CHUNK_SIZE) == []
+    assert downloaded(server, tmp_path, "big.tif")
+
+
+def test_remote_file_changed(server, tmp_path):
+    url, path = images(server, tmp_path, ["big.tif"])[0]
+    download = Download(url, path, CHUNK_SIZE)
+    download.prepare(timeout=10)
+    download.fetch(0, bandwidth=Bandwidth(), progress=lambda size: None, timeout=10, retries=0)
+    server.files["/big.tif"] = os.urandom(5 * CHUNK_SIZE)
+
+    assert download_images([(url, path)], chunk_size=CHUNK_SIZE) == []
+    assert downloaded(server, tmp_path, "big.tif")
+
+
+def test_retries(server, tmp_path):
+    server.failures = 4
+
+    assert download_images(images(server, tmp_path), max_threads=2, chunk_size=CHUNK_SIZE, retries=5) == []
+    assert downloaded(server, tmp_path, "big.tif")
+    assert downloaded(server, tmp_path, "small.tif")
+
+
+def test_failures_reported(server, tmp_path):
+    failed = download_images(images(server, tmp_path, ["big.tif", "missing.tif"]), chunk_size=CHUNK_SIZE)
+
+    assert failed == [f"{server.url}/missing.tif"]
+    assert downloaded(server, tmp_path, "big.tif")
+
+
+def test_state_sidecar(server, tmp_path):
+    url, path = images(server, tmp_path, ["big.tif"])[0]
+    download = Download(url, path, CHUNK_SIZE)
+    download.prepare(timeout=10)
+
+    with open(download.state) as fp:
+        state = json.load(fp)
+    assert state["size"] == len(server.files["/big.tif"])
+    assert state["etag"] == '"{}"'.format(hashlib.md5(server.files["/big.tif"]).hexdigest())
+    assert state["done"] == []
+    assert os.path.getsize(download.part) == state["size"]